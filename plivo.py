@@ -1,14 +1,18 @@
-import xml.etree.ElementTree as etree
-import base64
-import hmac
-from hashlib import sha1
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
 
-import requests
+# requests, json, hmac/base64 and ElementTree are imported where they are
+# first used so that `import plivo` stays cheap for processes that only
+# validate signatures or only build XML.
 
 try:
-    import json
+    import Queue as queue
 except ImportError:
-    import simplejson as json
+    import queue
 
 
 PLIVO_VERSION = "v1"
@@ -18,456 +22,2898 @@ class PlivoError(Exception):
     pass
 
 
-def validate_signature(uri, post_params, signature, auth_token):
-    for k, v in sorted(post_params.items()):
-        uri += k + v
-    return base64.encodestring(hmac.new(auth_token, uri, sha1).digest()).strip() == signature
+class PlivoTimeout(PlivoError):
+    pass
 
 
-class RestAPI(object):
-    def __init__(self, auth_id, auth_token, url='https://api.plivo.com', version=PLIVO_VERSION):
-        self.version = version
-        self.url = url.rstrip('/') + '/' + self.version
-        self.auth_id = auth_id
-        self.auth_token = auth_token
-        self._api = self.url + '/Account/%s' % self.auth_id
-        self.headers = {'User-Agent':'PythonPlivo'}
+class CircuitOpenError(PlivoError):
+    pass
 
-    def _request(self, method, path, data={}):
-        path = path.rstrip('/') + '/'
-        if method == 'POST':
-            headers = {'content-type': 'application/json'}
-            headers.update(self.headers)
-            r = requests.post(self._api + path, headers=headers,
-                              auth=(self.auth_id, self.auth_token),
-                              data=json.dumps(data))
-        elif method == 'GET':
-            r = requests.get(self._api + path, headers=self.headers,
-                             auth=(self.auth_id, self.auth_token),
-                             params=data)
-        elif method == 'DELETE':
-            r = requests.delete(self._api + path, headers=self.headers,
-                                auth=(self.auth_id, self.auth_token),
-                                params=data)
-        elif method == 'PUT':
-            headers = {'content-type': 'application/json'}
-            headers.update(self.headers)
-            r = requests.put(self._api + path, headers=headers,
-                             auth=(self.auth_id, self.auth_token),
-                             data=json.dumps(data))
-        content = r.content
-        if content:
+
+class Deadline(object):
+    def __init__(self, timeout):
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class _Future(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        if timeout is not None and timeout <= 0 or not self._event.wait(timeout):
+            raise PlivoTimeout('timed out waiting for result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class _TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = max(self.rate, 1.0)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+# Runs submitted tasks on `workers` threads, each taking the next task from
+# one shared queue as soon as it is free.
+class _Executor(object):
+    def __init__(self, workers):
+        self._queues = [queue.Queue()]
+        self._threads = []
+        for i in range(workers):
+            self._start(self._queues[0])
+
+    def _start(self, q):
+        t = threading.Thread(target=self._work, args=(q,))
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        future = _Future()
+        self._queues[0].put((future, fn, args, kwargs))
+        return future
+
+    @staticmethod
+    def _work(q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
             try:
-                response = json.loads(content)
-            except ValueError:
-                response = content
-        else:
-            response = content
-        return (r.status_code, response)
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def shutdown(self, wait=True):
+        for q in self._queues:
+            for i in range(len(self._threads) // len(self._queues)):
+                q.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+# Runs each submitted task on the worker owning hash(key), so tasks sharing a
+# key run one at a time in submission order.
+class _ShardedExecutor(_Executor):
+    def __init__(self, workers):
+        self._queues = [queue.Queue() for i in range(workers)]
+        self._threads = []
+        for q in self._queues:
+            self._start(q)
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = _Future()
+        self._queues[hash(key) % len(self._queues)].put((future, fn, args, kwargs))
+        return future
+
+
+class Metrics(object):
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register(self, name, fn):
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = dict(self._counters)
+        for name, fn in self._gauges.items():
+            snapshot[name] = fn()
+        for name in ('request', 'response'):
+            wire = snapshot.get(name + '_bytes_wire')
+            if wire:
+                snapshot[name + '_compression_ratio'] = \
+                    float(snapshot.get(name + '_bytes', 0)) / wire
+        return snapshot
+
+
+# Settles on the first attempt to answer with a status below 500, or on the
+# last attempt's outcome if none does. Attempts are handed to `submit`.
+class _Race(object):
+    def __init__(self, submit):
+        self.future = _Future()
+        self.winner = None
+        self._submit = submit
+        self._attempts = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def run(self, fn, *args):
+        with self._lock:
+            if self.future.done():
+                return
+            attempt = self._attempts
+            self._attempts += 1
+            self._running += 1
+        self._submit(self._attempt, attempt, fn, args)
+
+    def _attempt(self, attempt, fn, args):
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        with self._lock:
+            self._running -= 1
+            if self.future.done():
+                return
+            if error is None and result[0] < 500:
+                self.winner = attempt
+                self.future.set_result(result)
+            elif self._running == 0:
+                if error is None:
+                    self.future.set_result(result)
+                else:
+                    self.future.set_exception(error)
+
+
+# A hedge scheduled by Hedging.schedule(): fn(*args) is called once its
+# delay has passed, unless it was cancelled first or no hedge token is left.
+class _Hedge(object):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self, try_acquire):
+        if not self.cancelled and try_acquire():
+            self.fn(*self.args)
+
+
+# Hedging for idempotent GETs: when a request has not answered within the
+# given percentile of recent latencies, an identical second request is sent
+# and the first response below 500 wins. Only first requests' latencies are
+# recorded. Every request earns `budget` of a token (up to `burst`) and every
+# hedge spends one, so at most that fraction of requests is hedged.
+#
+# Before min_samples latencies are known requests run on the caller's
+# thread. After that both attempts run on worker threads that are kept for
+# `idle_timeout` seconds and reused, and one timer thread sends the hedges.
+class Hedging(object):
+    def __init__(self, percentile=95, budget=0.05, burst=10, window=200,
+                 min_samples=20, idle_timeout=60):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.idle_timeout = idle_timeout
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._timer = None
+        self._tasks = queue.Queue()
+        self._idle = 0
+        self._closed = False
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def delay(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.budget)
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def try_acquire(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def schedule(self, delay, fn, *args):
+        hedge = _Hedge(fn, args)
+        with self._cond:
+            heapq.heappush(self._pending, (time.time() + delay, next(self._seq), hedge))
+            if self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Thread(target=self._fire_due)
+                self._timer.daemon = True
+                self._timer.start()
+            self._cond.notify()
+        return hedge
+
+    def _fire_due(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._pending[0][0] - time.time() if self._pending else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                hedge = heapq.heappop(self._pending)[2]
+            hedge.fire(self.try_acquire)
+
+    def submit(self, fn, *args):
+        # Runs fn(*args) on an idle worker, starting one if none is idle.
+        with self._lock:
+            idle = self._idle > 0
+            if idle:
+                self._idle -= 1
+        if not idle:
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+        self._tasks.put((fn, args))
+
+    def close(self):
+        # Stops the idle workers; busy ones stop when their task is done.
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, 0
+        for _ in range(idle):
+            self._tasks.put(None)
+
+    def _work(self):
+        while True:
+            try:
+                task = self._tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # Every idle worker may already be promised to a task
+                    # on its way into the queue.
+                    if self._idle == 0:
+                        continue
+                    self._idle -= 1
+                return
+            if task is None:
+                return
+            fn, args = task
+            fn(*args)
+            with self._lock:
+                if self._closed:
+                    return
+                self._idle += 1
+
+
+def _path_template(path):
+    # '/Conference/plivo/Member/12/Mute/' -> '/Conference/{}/Member/{}/Mute/'
+    segments = path.strip('/').split('/')
+    for i in range(1, len(segments), 2):
+        segments[i] = '{}'
+    return '/' + '/'.join(segments) + '/' if segments[0] else '/'
+
+
+class _Circuit(object):
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.successes = 0
+
+
+# Tracks one circuit per endpoint template. A circuit opens after
+# failure_threshold consecutive failures (exceptions, 5xx responses or
+# responses slower than latency_threshold), rejects calls with
+# CircuitOpenError for recovery_timeout seconds, then lets half_open_probes
+# calls through and closes again once they all succeed.
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=5, latency_threshold=None,
+                 recovery_timeout=30, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_probes = half_open_probes
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def before(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None:
+                circuit = self._circuits[key] = _Circuit()
+            if circuit.state == 'open':
+                if time.time() - circuit.opened_at < self.recovery_timeout:
+                    raise CircuitOpenError('circuit open for %s' % key)
+                circuit.state = 'half_open'
+                circuit.probes = circuit.successes = 0
+            if circuit.state == 'half_open':
+                if circuit.probes >= self.half_open_probes:
+                    raise CircuitOpenError('circuit half open for %s' % key)
+                circuit.probes += 1
+
+    def after(self, key, ok, latency):
+        if self.latency_threshold is not None and latency > self.latency_threshold:
+            ok = False
+        with self._lock:
+            circuit = self._circuits[key]
+            if circuit.state == 'half_open':
+                if not ok:
+                    self._open(circuit)
+                else:
+                    circuit.successes += 1
+                    if circuit.successes >= self.half_open_probes:
+                        circuit.state = 'closed'
+                        circuit.failures = 0
+            elif circuit.state == 'closed':
+                if ok:
+                    circuit.failures = 0
+                else:
+                    circuit.failures += 1
+                    if circuit.failures >= self.failure_threshold:
+                        self._open(circuit)
 
     @staticmethod
-    def get_param(params, key):
+    def _open(circuit):
+        circuit.state = 'open'
+        circuit.opened_at = time.time()
+
+    def states(self):
+        with self._lock:
+            return dict((key, circuit.state)
+                        for key, circuit in self._circuits.items())
+
+
+# Splits one client's connections and request rate between interactive
+# calls and bulk traffic. Interactive requests may use all `concurrency`
+# slots and the full `rate` (requests per second, None for unlimited). Bulk
+# requests only start while `reserved` slots are free and no interactive
+# request is waiting, and are held to rate - reserved_rate per second.
+class PriorityLanes(object):
+    def __init__(self, concurrency=10, reserved=4, rate=None, reserved_rate=None):
+        if not 0 <= reserved < concurrency:
+            raise ValueError('reserved must be less than concurrency')
+        self.concurrency = concurrency
+        self.reserved = reserved
+        self._rate = self._bulk_rate = None
+        if rate:
+            if reserved_rate is None:
+                reserved_rate = float(rate) * reserved / concurrency
+            if reserved_rate >= rate:
+                raise ValueError('reserved_rate must be less than rate')
+            self._rate = _TokenBucket(rate)
+            self._bulk_rate = _TokenBucket(rate - reserved_rate)
+        self._active = 0
+        self._bulk = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+    def _wait_time(self, bulk):
+        if self._rate is None:
+            return 0
+        wait = self._rate.wait_time()
+        if bulk:
+            wait = max(wait, self._bulk_rate.wait_time())
+        return wait
+
+    def acquire(self, bulk=False, deadline=None):
+        limit = self.concurrency - self.reserved if bulk else self.concurrency
+        with self._cond:
+            if not bulk:
+                self._waiting += 1
+            try:
+                while True:
+                    wait = None
+                    if self._active < limit and not (bulk and self._waiting):
+                        wait = self._wait_time(bulk)
+                        if wait <= 0:
+                            if self._rate is not None:
+                                self._rate.try_acquire()
+                                if bulk:
+                                    self._bulk_rate.try_acquire()
+                            self._active += 1
+                            if bulk:
+                                self._bulk += 1
+                            return
+                    if deadline is not None:
+                        remaining = deadline.remaining()
+                        if remaining <= 0 or wait is not None and wait > remaining:
+                            raise PlivoTimeout('deadline exceeded waiting for a %s slot'
+                                               % ('bulk' if bulk else 'interactive'))
+                        if wait is None:
+                            wait = remaining
+                    self._cond.wait(wait)
+            finally:
+                if not bulk:
+                    self._waiting -= 1
+                    self._cond.notify_all()
+
+    def release(self, bulk=False):
+        with self._cond:
+            self._active -= 1
+            if bulk:
+                self._bulk -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'interactive': self._active - self._bulk, 'bulk': self._bulk,
+                    'waiting': self._waiting}
+
+
+# A token bucket of `rate` requests per second (bursting to `capacity`) per
+# auth_id, shared by every process on the host that points at the same
+# `directory`, by default a per-user directory in the system temp dir. Each
+# bucket is a small memory-mapped file updated under an exclusive flock, so
+# workers forked from one parent still draw from a single budget. Needs
+# fcntl, so Unix only.
+class SharedRateLimiter(object):
+    def __init__(self, rate, capacity=None, directory=None):
+        import fcntl
+        import struct
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1.0))
+        self.directory = directory
+        self._fcntl = fcntl
+        self._state = struct.Struct('dd')
+        self._buckets = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _path(self, auth_id):
+        import os
+        name = ''.join(c for c in auth_id if c.isalnum())
+        return os.path.join(self.directory or self._private_directory(),
+                            'plivo-ratelimit-%s' % name)
+
+    @staticmethod
+    def _private_directory():
+        # The default is a per-user directory under the system temp dir that
+        # only its owner can reach, so other users can't plant or share
+        # bucket files.
+        import errno
+        import os
+        import stat
+        import tempfile
+        directory = os.path.join(tempfile.gettempdir(), 'plivo-ratelimit-%d' % os.getuid())
         try:
-            return params[key]
-        except KeyError:
-            raise PlivoException("missing mandatory parameter %s" % key)
+            os.mkdir(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+                or info.st_mode & 0o077:
+            raise PlivoError('%s is not a private directory' % directory)
+        return directory
+
+    def _bucket(self, auth_id):
+        # Reopened after a fork; flock does not exclude processes sharing
+        # one open file.
+        import mmap
+        import os
+        with self._lock:
+            if self._pid != os.getpid():
+                self._close_buckets()
+                self._pid = os.getpid()
+            bucket = self._buckets.get(auth_id)
+            if bucket is None:
+                fd = os.open(self._path(auth_id),
+                             os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+                self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < self._state.size:
+                        os.ftruncate(fd, self._state.size)
+                        os.write(fd, self._state.pack(self.capacity, time.time()))
+                finally:
+                    self._fcntl.flock(fd, self._fcntl.LOCK_UN)
+                bucket = self._buckets[auth_id] = (fd, mmap.mmap(fd, self._state.size),
+                                                   threading.Lock())
+            return bucket
+
+    def _close_buckets(self):
+        # In a forked child these are inherited copies; closing them leaves
+        # the parent's open.
+        import os
+        buckets, self._buckets = self._buckets, {}
+        for fd, state, lock in buckets.values():
+            state.close()
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            self._close_buckets()
+
+    def _update(self, auth_id, tokens, penalty=0.0):
+        # Takes `tokens` if available and returns 0, or returns the seconds
+        # until they will be. Threads of one process share the fd, and with
+        # it the flock, so they are kept apart by the bucket's own lock.
+        fd, state, lock = self._bucket(auth_id)
+        with lock:
+            return self._update_locked(fd, state, tokens, penalty)
+
+    def _update_locked(self, fd, state, tokens, penalty):
+        self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+        try:
+            available, stamp = self._state.unpack(state[:self._state.size])
+            now = time.time()
+            available = min(self.capacity, available + max(0.0, now - stamp) * self.rate)
+            if penalty:
+                available = min(available, 0.0) - penalty * self.rate
+            wait = 0.0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / self.rate
+            state[:self._state.size] = self._state.pack(available, max(now, stamp))
+            return wait
+        finally:
+            self._fcntl.flock(fd, self._fcntl.LOCK_UN)
+
+    def acquire(self, auth_id, tokens=1, deadline=None):
+        # Returns the seconds spent waiting.
+        waited = 0.0
+        while True:
+            wait = self._update(auth_id, tokens)
+            if not wait:
+                return waited
+            if deadline is not None and wait > deadline.remaining():
+                raise PlivoTimeout('deadline exceeded waiting for rate limit')
+            time.sleep(wait)
+            waited += wait
+
+    def backoff(self, auth_id, seconds):
+        # Empties the bucket and keeps it empty for `seconds`, e.g. after a
+        # 429, so every process holds off.
+        self._update(auth_id, 0, seconds)
+
+
+def _freeze(params):
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                        for k, v in params.items()))
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _signature(mac, uri, post_params):
+    # mac is an HMAC-SHA1 keyed with the auth token; it is copied, not updated.
+    import base64
+    for k, v in sorted(post_params.items()):
+        uri += k + v
+    mac = mac.copy()
+    mac.update(_to_bytes(uri))
+    return base64.b64encode(mac.digest()).decode('ascii')
 
-    ## Accounts ##
-    def get_account(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '', data=params)
 
-    def modify_account(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '', data=params)
+def validate_signature(uri, post_params, signature, auth_token):
+    import hmac
+    from hashlib import sha1
+    mac = hmac.new(_to_bytes(auth_token), digestmod=sha1)
+    return _signature(mac, uri, post_params) == signature
+
+
+def _query_string(params):
+    try:
+        from urllib import urlencode
+    except ImportError:
+        from urllib.parse import urlencode
+    pairs = []
+    for k, values in params.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for v in values:
+            if v is None:
+                continue
+            if not isinstance(v, bytes) and hasattr(v, 'encode'):
+                v = v.encode('utf-8')
+            pairs.append((k, v))
+    return urlencode(pairs)
+
+
+## JSON codecs ##
+# A codec turns request data into a JSON body (bytes) and decodes response
+# bodies given as bytes.
+class JSONCodec(object):
+    def __init__(self):
+        try:
+            import json
+        except ImportError:
+            import simplejson as json
+        self._json = json
+
+    def dumps(self, obj):
+        return self._json.dumps(obj).encode('utf-8')
 
-    def get_subaccounts(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Subaccount/', data=params)
+    def loads(self, data):
+        return self._json.loads(data)
 
-    def create_subaccount(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Subaccount/', data=params)
 
-    def get_subaccount(self, params=None):
-        if not params: params = {}
-        subauth_id = params.pop("subauth_id")
-        return self._request('GET', '/Subaccount/%s/' % subauth_id, data=params)
+class OrjsonCodec(JSONCodec):
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
 
-    def modify_subaccount(self, params=None):
-        if not params: params = {}
-        subauth_id = params.pop("subauth_id")
-        return self._request('POST', '/Subaccount/%s/' % subauth_id, data=params)
+    def dumps(self, obj):
+        return self._orjson.dumps(obj)
 
-    def delete_subaccount(self, params=None):
-        if not params: params = {}
-        subauth_id = params.pop("subauth_id")
-        return self._request('DELETE', '/Subaccount/%s/' % subauth_id, data=params)
+    def loads(self, data):
+        return self._orjson.loads(data)
 
-    ## Applications ##
-    def get_applications(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Application/', data=params)
 
-    def create_application(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Application/', data=params)
+class UjsonCodec(JSONCodec):
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
 
-    def get_application(self, params=None):
-        if not params: params = {}
-        app_id = params.pop("app_id")
-        return self._request('GET', '/Application/%s/' % app_id, data=params)
+    def dumps(self, obj):
+        return self._ujson.dumps(obj).encode('utf-8')
 
-    def modify_application(self, params=None):
-        if not params: params = {}
-        app_id = params.pop("app_id")
-        return self._request('POST', '/Application/%s/' % app_id, data=params)
+    def loads(self, data):
+        return self._ujson.loads(data)
 
-    def delete_application(self, params=None):
-        if not params: params = {}
-        app_id = params.pop("app_id")
-        return self._request('DELETE', '/Application/%s/' % app_id, data=params)
 
-    ## Numbers ##
-    def get_numbers(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Number/', data=params)
-
-    def search_numbers(self, params=None):
-        raise PendingDeprecationWarning("This API is deprecated. Consider "
-                                        "using get_number_group_details")
-        if not params: params = {}
-        return self._request('GET', '/AvailableNumber/', data=params)
-
-    def get_number(self, params=None):
-        if not params: params = {}
-        number = params.pop("number")
-        return self._request('GET', '/Number/%s/' % number, data=params)
-
-    def rent_number(self, params=None):
-        raise PendingDeprecationWarning("This API is deprecated. Consider "
-                                        "using rent_from_number_group")
-        if not params: params = {}
-        number = params.pop("number")
-        return self._request('POST', '/AvailableNumber/%s/' % number, data=params)
-
-    def unrent_number(self, params=None):
-        if not params: params = {}
-        number = params.pop("number")
-        return self._request('DELETE', '/Number/%s/' % number, data=params)
-
-    def add_carrier_number(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Number/', data=params)
-
-    def modify_number(self, params=None):
-        if not params: params = {}
-        number = params.pop("number")
-        return self._request('POST', '/Number/%s/' % number, data=params)
-
-    def link_application_number(self, params=None):
-        if not params: params = {}
-        number = params.pop("number")
-        return self._request('POST', '/Number/%s/' % number, data=params)
-
-    def unlink_application_number(self, params=None):
-        if not params: params = {}
-        number = params.pop("number")
-        params = {'app_id':''}
-        return self._request('POST', '/Number/%s/' % number, data=params)
-
-    def get_number_group(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/AvailableNumberGroup/', data=params)
-
-    def get_number_group_details(self, params=None):
-        if not params: params = {}
-        group_id = params.pop('group_id')
-        return self._request('GET', '/AvailableNumberGroup/%s/' % group_id, data=params)
-
-    def rent_from_number_group(self, params=None):
-        if not params: params = {}
-        group_id = params.pop('group_id')
-        return self._request('POST', '/AvailableNumberGroup/%s/' % group_id, data=params)
+_default_codec = None
 
-    ## Calls ##
-    def get_cdrs(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Call/', data=params)
-
-    def get_cdr(self, params=None):
-        if not params: params = {}
-        record_id = params.pop('record_id')
-        return self._request('GET', '/Call/%s/' % record_id, data=params)
-
-    def get_live_calls(self, params=None):
-        if not params: params = {}
-        params['status'] = 'live'
-        return self._request('GET', '/Call/', data=params)
-
-    def get_live_call(self, params=None):
-        if not params: params={}
-        params['status'] = 'live'
-        call_uuid = params.pop('call_uuid')
-        return self._request('GET', '/Call/%s/' % call_uuid, data=params)
-
-    def get_call(self, params=None):
-        if not params: params={}
-        call_uuid = params.pop('call_uuid')
-        return self._request('GET', '/Call/%s/' % call_uuid, data=params)
-
-    def make_call(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Call/', data=params)
-
-    def hangup_all_calls(self, params=None):
-        if not params: params = {}
-        return self._request('DELETE', '/Call/', data=params)
-
-    def transfer_call(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('POST', '/Call/%s/' % call_uuid, data=params)
-
-    def hangup_call(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('DELETE', '/Call/%s/' % call_uuid, data=params)
-
-    def record(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('POST', '/Call/%s/Record/' % call_uuid, data=params)
-
-    def stop_record(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('DELETE', '/Call/%s/Record/' % call_uuid, data=params)
-
-    def play(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('POST', '/Call/%s/Play/' % call_uuid, data=params)
-
-    def stop_play(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('DELETE', '/Call/%s/Play/' % call_uuid, data=params)
-
-    def speak(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('POST', '/Call/%s/Speak/' % call_uuid, data=params)
-
-    def stop_speak(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('DELETE', '/Call/%s/Speak/' % call_uuid, data=params)
-
-    def send_digits(self, params=None):
-        if not params: params = {}
-        call_uuid = params.pop('call_uuid')
-        return self._request('POST', '/Call/%s/DTMF/' % call_uuid, data=params)
 
-    ## Calls requests ##
-    def hangup_request(self, params=None):
-        if not params: params = {}
-        request_uuid = params.pop('request_uuid')
-        return self._request('DELETE', '/Request/%s/' % request_uuid, data=params)
+def default_codec():
+    global _default_codec
+    if _default_codec is None:
+        for codec_class in (OrjsonCodec, UjsonCodec, JSONCodec):
+            try:
+                _default_codec = codec_class()
+                break
+            except ImportError:
+                pass
+    return _default_codec
 
-    ## Conferences ##
-    def get_live_conferences(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Conference/', data=params)
 
-    def hangup_all_conferences(self, params=None):
-        if not params: params = {}
-        return self._request('DELETE', '/Conference/', data=params)
+def _decode(codec, content):
+    if not content:
+        return content
+    try:
+        return codec.loads(content)
+    except ValueError:
+        return content
 
-    def get_live_conference(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        return self._request('GET', '/Conference/%s/' % conference_name, data=params)
 
-    def hangup_conference(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        return self._request('DELETE', '/Conference/%s/' % conference_name, data=params)
+_undecoded = object()
 
-    def hangup_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('DELETE', '/Conference/%s/Member/%s/' % (conference_name, member_id), data=params)
 
-    def play_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('POST', '/Conference/%s/Member/%s/Play/' % (conference_name, member_id), data=params)
+# Stands in for a decoded response body, decoding the raw content on first
+# use. Reads like the dict (or raw content) it decodes to.
+class _LazyBody(object):
+    __slots__ = ('content', '_codec', '_value')
 
-    def stop_play_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('DELETE', '/Conference/%s/Member/%s/Play/' % (conference_name, member_id), data=params)
+    def __init__(self, content, codec):
+        self.content = content
+        self._codec = codec
+        self._value = _undecoded
 
-    def speak_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('POST', '/Conference/%s/Member/%s/Speak/' % (conference_name, member_id), data=params)
+    @property
+    def value(self):
+        if self._value is _undecoded:
+            self._value = _decode(self._codec, self.content)
+        return self._value
 
-    def deaf_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('POST', '/Conference/%s/Member/%s/Deaf/' % (conference_name, member_id), data=params)
+    def __getattr__(self, name):
+        return getattr(self.value, name)
 
-    def undeaf_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('DELETE', '/Conference/%s/Member/%s/Deaf/' % (conference_name, member_id), data=params)
+    def __getitem__(self, key):
+        return self.value[key]
 
-    def mute_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('POST', '/Conference/%s/Member/%s/Mute/' % (conference_name, member_id), data=params)
+    def __contains__(self, key):
+        return key in self.value
 
-    def unmute_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('DELETE', '/Conference/%s/Member/%s/Mute/' % (conference_name, member_id), data=params)
+    def __iter__(self):
+        return iter(self.value)
 
-    def kick_member(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        member_id = params.pop('member_id')
-        return self._request('POST', '/Conference/%s/Member/%s/Kick/' % (conference_name, member_id), data=params)
+    def __len__(self):
+        return len(self.value)
 
-    def record_conference(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        return self._request('POST', '/Conference/%s/Record/' % conference_name, data=params)
+    def __bool__(self):
+        return bool(self.value)
+    __nonzero__ = __bool__
 
-    def stop_record_conference(self, params=None):
-        if not params: params = {}
-        conference_name = params.pop('conference_name')
-        return self._request('DELETE', '/Conference/%s/Record/' % conference_name, data=params)
+    def __eq__(self, other):
+        if isinstance(other, _LazyBody):
+            other = other.value
+        return self.value == other
 
-    ## Recordings ##
-    def get_recordings(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Recording/', data=params)
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+# A (status, response) tuple whose response is only decoded when something
+# reads it, for callers that mostly look at the status. Returned instead of
+# a plain tuple when a client or call asks for lazy=True.
+class LazyResponse(tuple):
+    __slots__ = ()
+
+    def __new__(cls, status, content, codec):
+        return tuple.__new__(cls, (status, _LazyBody(content, codec)))
+
+    @property
+    def status(self):
+        return self[0]
+
+    @property
+    def content(self):
+        return self[1].content
+
+    @property
+    def response(self):
+        return self[1].value
+
+
+## Transports ##
+# A transport sends one HTTP request. send() returns (status, headers, body)
+# with the body already content-decoded; stream() returns (status, headers,
+# chunks) with the chunks exactly as received, leaving any Content-Encoding
+# to the caller. Subclasses implement at least one of the two.
+#
+# timeout is None or a (connect, read) tuple of seconds; transports raise
+# PlivoTimeout when either runs out.
+def _timeout_pair(timeout):
+    # Turns a number or (connect, read) tuple of seconds into the tuple form
+    # transports take.
+    if timeout is None or isinstance(timeout, tuple):
+        return timeout
+    return (timeout, timeout)
+
+
+class Transport(object):
+    chunk_size = 16384
+
+    def prewarm(self, url, connections=1):
+        # Opens up to `connections` pooled connections to url's host ahead of
+        # use and returns how many were opened.
+        return 0
+
+    def send(self, method, url, headers, body, timeout=None):
+        status, headers, chunks = self.stream(method, url, headers, body, timeout)
+        return (status, headers, _decode_content(headers, chunks)[0])
+
+    def stream(self, method, url, headers, body, timeout=None):
+        status, headers, body = self.send(method, url, headers, body, timeout)
+        headers = dict((k, v) for k, v in headers.items()
+                       if k.lower() != 'content-encoding')
+        return (status, headers, [body])
+
+
+def _get_header(headers, name):
+    for k, v in headers.items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def _decode_content(headers, chunks):
+    # Returns (body, wire_size), decompressing gzip/deflate chunk by chunk.
+    encoding = (_get_header(headers, 'content-encoding') or '').strip().lower()
+    decompressor = None
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        import zlib
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    parts = []
+    wire_size = 0
+    for chunk in chunks:
+        wire_size += len(chunk)
+        parts.append(decompressor.decompress(chunk) if decompressor else chunk)
+    if decompressor:
+        parts.append(decompressor.flush())
+    return (b''.join(parts), wire_size)
+
+
+def _gzip(body):
+    import zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _iter_raw(response, chunk_size, timeout_errors):
+    try:
+        for chunk in response.stream(chunk_size, decode_content=False):
+            yield chunk
+    except timeout_errors as e:
+        raise PlivoTimeout(str(e))
+    finally:
+        response.release_conn()
+
+
+def _until(deadline, chunks):
+    for chunk in chunks:
+        if deadline.expired():
+            raise PlivoTimeout('deadline exceeded')
+        yield chunk
+
+
+# Caches the address each host resolves to for `ttl` seconds.
+class _DNSCache(object):
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((host, port))
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        import socket
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._entries[(host, port)] = (address, now + self.ttl)
+        return address
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+def _connection_class(base, dns_cache, tcp_keepalive):
+    # The host is only swapped for the address while the socket is opened,
+    # so the Host header and certificate checks still use the name.
+    class Connection(base):
+        def _new_conn(self):
+            host = self._dns_host
+            if dns_cache is not None:
+                self._dns_host = dns_cache.resolve(host, self.port)
+            try:
+                sock = base._new_conn(self)
+            except Exception:
+                if dns_cache is not None:
+                    dns_cache.invalidate(host, self.port)
+                raise
+            finally:
+                self._dns_host = host
+            if tcp_keepalive:
+                import socket
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            return sock
+    return Connection
+
+
+def _tune_pool_manager(pool_manager, dns_ttl, tcp_keepalive):
+    if not dns_ttl and not tcp_keepalive:
+        return
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    dns_cache = _DNSCache(dns_ttl) if dns_ttl else None
+    pool_manager.pool_classes_by_scheme = dict(
+        (scheme, type(base.__name__, (base,), {'ConnectionCls': _connection_class(
+            base.ConnectionCls, dns_cache, tcp_keepalive)}))
+        for scheme, base in (('http', HTTPConnectionPool), ('https', HTTPSConnectionPool)))
+
+
+def _prewarm_pool(pool, connections):
+    # Connects up to `connections` of the pool's idle connections and returns
+    # how many had to be opened.
+    held = []
+    opened = 0
+    try:
+        for _ in range(min(connections, pool.pool.maxsize)):
+            conn = pool._get_conn()
+            held.append(conn)
+            if getattr(conn, 'sock', None) is None:
+                conn.connect()
+                opened += 1
+    finally:
+        for conn in held:
+            pool._put_conn(conn)
+    return opened
+
+
+# With dns_ttl set, host lookups are cached for that many seconds; with
+# tcp_keepalive, new connections send TCP keepalive probes while idle.
+class RequestsTransport(Transport):
+    def __init__(self, session=None, pool_maxsize=10, dns_ttl=None, tcp_keepalive=False):
+        import requests
+        if session is None:
+            # One transport serves many accounts (see ClientPool), so cookies
+            # set in answer to one account must never go out with another's
+            # requests: the session keeps none.
+            try:
+                from cookielib import DefaultCookiePolicy
+            except ImportError:
+                from http.cookiejar import DefaultCookiePolicy
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        for adapter in session.adapters.values():
+            if hasattr(adapter, 'poolmanager'):
+                _tune_pool_manager(adapter.poolmanager, dns_ttl, tcp_keepalive)
+        self.session = session
+        self._timeout_errors = (requests.exceptions.Timeout,
+                                requests.packages.urllib3.exceptions.TimeoutError)
+
+    def _request(self, method, url, headers, body, timeout, stream):
+        try:
+            return self.session.request(method, url, headers=headers, data=body,
+                                        timeout=timeout, stream=stream)
+        except self._timeout_errors as e:
+            raise PlivoTimeout(str(e))
+
+    def send(self, method, url, headers, body, timeout=None):
+        r = self._request(method, url, headers, body, timeout, False)
+        return (r.status_code, r.headers, r.content)
+
+    def prewarm(self, url, connections=1):
+        # Picks the pool requests itself would use for url.
+        import requests
+        adapter = self.session.get_adapter(url)
+        verify = self.session.verify
+        if hasattr(adapter, 'get_connection_with_tls_context'):
+            pool = adapter.get_connection_with_tls_context(
+                requests.Request('GET', url).prepare(), verify)
+        else:
+            pool = adapter.get_connection(url)
+            adapter.cert_verify(pool, url, verify, None)
+        return _prewarm_pool(pool, connections)
+
+    def stream(self, method, url, headers, body, timeout=None):
+        r = self._request(method, url, headers, body, timeout, True)
+        return (r.status_code, r.headers,
+                _iter_raw(r.raw, self.chunk_size, self._timeout_errors))
+
+
+# Talks to a urllib3 connection pool directly, skipping the hooks, settings
+# merging and auth handling requests does on every call.
+class Urllib3Transport(Transport):
+    def __init__(self, num_pools=10, maxsize=10, pool_manager=None, dns_ttl=None,
+                 tcp_keepalive=False):
+        import urllib3
+        if pool_manager is None:
+            options = {'num_pools': num_pools, 'maxsize': maxsize,
+                       'cert_reqs': 'CERT_REQUIRED'}
+            try:
+                import certifi
+                options['ca_certs'] = certifi.where()
+            except ImportError:
+                pass
+            pool_manager = urllib3.PoolManager(**options)
+        _tune_pool_manager(pool_manager, dns_ttl, tcp_keepalive)
+        self.pool_manager = pool_manager
+        self._timeout = urllib3.Timeout
+        self._timeout_errors = urllib3.exceptions.TimeoutError
+
+    def _urlopen(self, method, url, headers, body, timeout, **kwargs):
+        if timeout is not None:
+            kwargs['timeout'] = self._timeout(connect=timeout[0], read=timeout[1])
+        try:
+            return self.pool_manager.urlopen(method, url, body=body, headers=headers,
+                                             retries=False, **kwargs)
+        except self._timeout_errors as e:
+            raise PlivoTimeout(str(e))
+
+    def send(self, method, url, headers, body, timeout=None):
+        r = self._urlopen(method, url, headers, body, timeout)
+        return (r.status, r.headers, r.data)
+
+    def prewarm(self, url, connections=1):
+        return _prewarm_pool(self.pool_manager.connection_from_url(url), connections)
+
+    def stream(self, method, url, headers, body, timeout=None):
+        r = self._urlopen(method, url, headers, body, timeout,
+                          preload_content=False, decode_content=False)
+        return (r.status, r.headers,
+                _iter_raw(r, self.chunk_size, self._timeout_errors))
+
+
+# Serves requests from handler(method, url, headers, body), which returns
+# (status, headers, body) with the body as it would appear on the wire.
+# Useful for tests and benchmarks.
+class MemoryTransport(Transport):
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+
+    def stream(self, method, url, headers, body, timeout=None):
+        self.requests.append((method, url, headers, body))
+        status, headers, body = self.handler(method, url, headers, body)
+        return (status, headers, [body])
+
+
+## Cassettes ##
+# Exchanges are stored one JSON object per line: method, url, request body,
+# status, content headers, raw response body and elapsed seconds. Bodies are
+# kept as text when they are UTF-8 and base64 otherwise. Credentials are
+# never written: the Authorization header is not recorded and auth_token
+# fields in JSON response bodies are masked.
+def _pack(data):
+    if data is None:
+        return None
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    try:
+        return {'text': data.decode('utf-8')}
+    except UnicodeDecodeError:
+        import base64
+        return {'base64': base64.b64encode(data).decode('ascii')}
+
+
+def _unpack(packed):
+    if packed is None:
+        return None
+    if 'text' in packed:
+        return packed['text'].encode('utf-8')
+    import base64
+    return base64.b64decode(packed['base64'])
+
+
+def _scrub(content):
+    # Returns content with every auth_token value masked, or None when it
+    # holds none.
+    import json
+    try:
+        data = json.loads(content.decode('utf-8'))
+    except ValueError:
+        return None
+    found = []
+
+    def mask(value):
+        if isinstance(value, dict):
+            for key in value:
+                if key == 'auth_token':
+                    value[key] = 'XXXX'
+                    found.append(key)
+                else:
+                    mask(value[key])
+        elif isinstance(value, list):
+            for item in value:
+                mask(item)
+    mask(data)
+    if not found:
+        return None
+    return json.dumps(data).encode('utf-8')
+
+
+def _cassette_url(url):
+    # Drops scheme, host and account ID so a cassette recorded with one
+    # account replays under another.
+    import re
+    url = re.sub(r'^[a-z]+://[^/]+', '', url)
+    return re.sub(r'/Account/[^/?]+', '/Account/-', url, count=1)
+
+
+class RecordingTransport(Transport):
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+
+    def stream(self, method, url, headers, body, timeout=None):
+        import json
+        started = time.time()
+        status, response_headers, chunks = self.transport.stream(
+            method, url, headers, body, timeout)
+        content = b''.join(chunks)
+        kept = dict((k.lower(), v) for k, v in response_headers.items()
+                    if k.lower() in ('content-type', 'content-encoding'))
+        recorded = content
+        scrubbed = _scrub(_decode_content(response_headers, [content])[0])
+        if scrubbed is not None:
+            recorded = scrubbed
+            kept.pop('content-encoding', None)
+        entry = {'method': method, 'url': _cassette_url(url),
+                 'body': _pack(body), 'status': status, 'headers': kept,
+                 'response': _pack(recorded),
+                 'elapsed': round(time.time() - started, 6)}
+        line = json.dumps(entry, sort_keys=True, separators=(',', ':')) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+        return (status, response_headers, [content])
+
+
+# Serves a cassette back. Exchanges are matched on method, url and body,
+# falling back to method and url; repeated requests get the recorded
+# responses in order, the last one repeating. With realtime=True each
+# response takes as long as it did when it was recorded.
+class ReplayTransport(Transport):
+    def __init__(self, path, realtime=False):
+        import json
+        self.realtime = realtime
+        self._exact = {}
+        self._loose = {}
+        self._lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                body = _unpack(entry['body'])
+                self._exact.setdefault((entry['method'], entry['url'], body), []).append(entry)
+                self._loose.setdefault((entry['method'], entry['url']), []).append(entry)
+
+    def _next(self, method, url, body):
+        url = _cassette_url(url)
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        with self._lock:
+            entries = (self._exact.get((method, url, body)) or
+                       self._loose.get((method, url)))
+            if not entries:
+                raise PlivoError('no recorded response for %s %s' % (method, url))
+            return entries.pop(0) if len(entries) > 1 else entries[0]
+
+    def stream(self, method, url, headers, body, timeout=None):
+        entry = self._next(method, url, body)
+        if self.realtime:
+            time.sleep(entry['elapsed'])
+        return (entry['status'], dict(entry['headers']), [_unpack(entry['response'])])
 
-    def get_recording(self, params=None):
-        if not params: params = {}
-        recording_id = params.pop('recording_id')
-        return self._request('GET', '/Recording/%s/' % recording_id, data=params)
 
+class RestAPI(object):
+    def __init__(self, auth_id, auth_token, url='https://api.plivo.com', version=PLIVO_VERSION,
+                 coalesce=False, transport=None, codec=None, compress_threshold=None,
+                 timeout=None, hedging=None, breaker=None, lanes=None, lazy=False,
+                 prewarm=0, keepalive=None, dns_ttl=None, rate_limiter=None):
+        import base64
+        self.version = version
+        self.url = url.rstrip('/') + '/' + self.version
+        self.auth_id = auth_id
+        self.auth_token = auth_token
+        self._api = self.url + '/Account/%s' % self.auth_id
+        self.headers = {'User-Agent':'PythonPlivo', 'Accept-Encoding': 'gzip, deflate'}
+        credentials = base64.b64encode(('%s:%s' % (auth_id, auth_token)).encode('utf-8'))
+        if not isinstance(credentials, str):
+            credentials = credentials.decode('ascii')
+        self._authorization = 'Basic ' + credentials
+        self.coalesce = coalesce
+        self.transport = transport
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.timeout = timeout
+        self.hedging = hedging
+        self.breaker = breaker
+        self.lanes = lanes
+        self.rate_limiter = rate_limiter
+        self.lazy = lazy
+        self.metrics = Metrics()
+        if breaker is not None:
+            self.metrics.register('circuit_breakers', breaker.states)
+        if lanes is not None:
+            self.metrics.register('lanes', lanes.stats)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._observers = []
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self._prewarm = prewarm
+        self._closed = threading.Event()
+        self._transport_lock = threading.Lock()
+        self._warmer = None
+        if prewarm or keepalive:
+            self._warmer = threading.Thread(target=self._keep_warm)
+            self._warmer.daemon = True
+            self._warmer.start()
+
+    # rate_limiter, a SharedRateLimiter, paces every upstream request made
+    # with this auth_id and is drained whenever the API answers 429.
+    #
+    # prewarm connections are opened in the background on construction and,
+    # every `keepalive` seconds, reopened if the server has dropped them. The
+    # default transport created for this client also caches DNS for dns_ttl
+    # seconds and enables TCP keepalive when keepalive is set.
+    def _get_transport(self):
+        # Locked so the warming thread and the first request share one
+        # transport.
+        if self.transport is None:
+            with self._transport_lock:
+                if self.transport is None:
+                    self.transport = RequestsTransport(
+                        dns_ttl=self.dns_ttl, tcp_keepalive=self.keepalive is not None)
+        return self.transport
+
+    def prewarm(self, connections=None):
+        opened = self._get_transport().prewarm(self.url, connections or self._prewarm or 1)
+        self.metrics.incr('prewarmed_connections', opened)
+        return opened
+
+    def _keep_warm(self):
+        while True:
+            try:
+                self.prewarm()
+            except Exception:
+                self.metrics.incr('prewarm_errors')
+            if self.keepalive is None or self._closed.wait(self.keepalive):
+                return
+
+    def close(self):
+        self._closed.set()
+
+    # Observers are called as fn(method, path, data, status, response) after
+    # every completed API call made through this client.
+    def subscribe(self, fn):
+        self._observers.append(fn)
+
+    def unsubscribe(self, fn):
+        self._observers.remove(fn)
+
+    # Every API method takes the keyword options timeout, a number or a
+    # (connect, read) tuple of seconds overriding the client's timeout, and
+    # deadline, a Deadline or a number of seconds bounding the whole call.
+    # Pass the same Deadline to successive calls to share one budget across
+    # retries or pages. With lanes set, priority='interactive' or 'bulk'
+    # overrides the endpoint's lane. lazy, defaulting to the client's,
+    # returns a LazyResponse that only decodes the body when it is read.
+    #
+    # endpoint is the ApiEndpoint being called; its template keys the circuit
+    # breaker, its idempotent flag allows hedging and coalescing and its bulk
+    # flag picks the lane. Requests without one are described by their path.
+    def _request(self, method, path, data={}, timeout=None, deadline=None, priority=None,
+                 lazy=None, endpoint=None):
+        path = path.rstrip('/') + '/'
+        if deadline is not None and not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        if endpoint is None:
+            endpoint = _endpoint(None, method, _path_template(path))
+        if priority is not None:
+            if priority not in ('interactive', 'bulk'):
+                raise ValueError('unknown priority %r' % (priority,))
+            endpoint = endpoint._replace(bulk=priority == 'bulk')
+        if lazy is None:
+            lazy = self.lazy
+        if method != 'GET' or not endpoint.idempotent:
+            result = self._send(method, path, data, timeout, deadline, endpoint, lazy)
+        elif self.coalesce:
+            result = self._coalesced_request(path, data, timeout, deadline, endpoint, lazy)
+        else:
+            result = self._get(path, data, timeout, deadline, endpoint, lazy)
+        for fn in self._observers:
+            fn(method, path, data, result[0], result[1])
+        return result
+
+    def _get(self, path, data, timeout, deadline, endpoint, lazy=False):
+        hedging = self.hedging
+        if hedging is None:
+            return self._send('GET', path, data, timeout, deadline, endpoint, lazy)
+        args = (path, data, timeout, deadline, endpoint, lazy)
+        delay = hedging.delay()
+        if delay is None:
+            return self._primary(*args)
+        race = _Race(hedging.submit)
+        race.run(self._primary, *args)
+        hedge = hedging.schedule(delay, race.run, self._hedge, *args)
+        try:
+            result = race.future.result(deadline.remaining() if deadline else None)
+        finally:
+            hedge.cancel()
+        if race.winner:
+            self.metrics.incr('hedge_wins')
+        return result
+
+    def _primary(self, path, data, timeout, deadline, endpoint, lazy):
+        started = time.time()
+        result = self._send('GET', path, data, timeout, deadline, endpoint, lazy)
+        self.hedging.record(time.time() - started)
+        return result
+
+    def _hedge(self, path, data, timeout, deadline, endpoint, lazy):
+        self.metrics.incr('hedged_requests')
+        return self._send('GET', path, data, timeout, deadline, endpoint, lazy)
+
+    def _coalesced_request(self, path, data, timeout, deadline, endpoint, lazy=False):
+        # Identical GETs already in flight share one upstream request. Every
+        # waiter gets the same response object, so treat it as read-only.
+        key = (path, _freeze(data), lazy)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = _Future()
+        if leader:
+            try:
+                result = self._get(path, data, timeout, deadline, endpoint, lazy)
+            except Exception as e:
+                with self._inflight_lock:
+                    del self._inflight[key]
+                future.set_exception(e)
+                raise
+            with self._inflight_lock:
+                del self._inflight[key]
+            future.set_result(result)
+        return future.result(deadline.remaining() if deadline else None)
+
+    def _timeouts(self, timeout, deadline):
+        if timeout is None:
+            timeout = self.timeout
+        connect, read = _timeout_pair(timeout) or (None, None)
+        if deadline is not None:
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                raise PlivoTimeout('deadline exceeded')
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        if connect is None and read is None:
+            return None
+        return (connect, read)
+
+    def _send(self, method, path, data, timeout, deadline, endpoint, lazy=False):
+        codec = self.codec or default_codec()
+        self._get_transport()
+        url = self._api + path
+        headers = dict(self.headers)
+        headers['Authorization'] = self._authorization
+        if method in ('POST', 'PUT'):
+            headers['content-type'] = 'application/json'
+            body = codec.dumps(data)
+            self.metrics.incr('request_bytes', len(body))
+            if self.compress_threshold is not None and len(body) >= self.compress_threshold:
+                body = _gzip(body)
+                headers['Content-Encoding'] = 'gzip'
+            self.metrics.incr('request_bytes_wire', len(body))
+        else:
+            body = None
+            if data:
+                url += '?' + _query_string(data)
+        status, content = self._exchange(method, url, headers, body,
+                                         self._timeouts(timeout, deadline), deadline, endpoint)
+        if lazy:
+            return LazyResponse(status, content, codec)
+        return (status, _decode(codec, content))
+
+    def _exchange(self, method, url, headers, body, timeouts, deadline, endpoint):
+        if self.rate_limiter is not None:
+            if self.rate_limiter.acquire(self.auth_id, deadline=deadline):
+                self.metrics.incr('rate_limit_waits')
+                timeouts = self._timeouts(timeouts, deadline)
+        if self.lanes is None:
+            return self._transfer(method, url, headers, body, timeouts, deadline,
+                                  endpoint.template)
+        self.lanes.acquire(endpoint.bulk, deadline)
+        try:
+            return self._transfer(method, url, headers, body,
+                                  self._timeouts(timeouts, deadline), deadline,
+                                  endpoint.template)
+        finally:
+            self.lanes.release(endpoint.bulk)
+
+    def _transfer(self, method, url, headers, body, timeouts, deadline, template):
+        key = None
+        if self.breaker is not None:
+            key = template
+            try:
+                self.breaker.before(key)
+            except CircuitOpenError:
+                self.metrics.incr('circuit_open_rejections')
+                raise
+        started = time.time()
+        try:
+            status, response_headers, chunks = self.transport.stream(
+                method, url, headers, body, timeouts)
+            if deadline is not None:
+                chunks = _until(deadline, chunks)
+            content, wire_size = _decode_content(response_headers, chunks)
+        except Exception:
+            if key is not None:
+                self.breaker.after(key, False, time.time() - started)
+            raise
+        if key is not None:
+            self.breaker.after(key, status < 500, time.time() - started)
+        self.metrics.incr('requests')
+        self.metrics.incr('response_bytes', len(content))
+        self.metrics.incr('response_bytes_wire', wire_size)
+        if status == 429 and self.rate_limiter is not None:
+            try:
+                seconds = float(_get_header(response_headers, 'retry-after'))
+            except (TypeError, ValueError):
+                seconds = 1.0
+            self.rate_limiter.backoff(self.auth_id, seconds)
+        return (status, content)
+
+    def _iterate(self, fetch, params, deadline=None, **options):
+        # Pages through a list endpoint. A numeric deadline covers the whole
+        # iteration, not each page.
+        params = dict(params or {})
+        params.setdefault('limit', 20)
+        offset = int(params.get('offset', 0))
+        if deadline is not None and not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        while True:
+            params['offset'] = offset
+            status, response = fetch(dict(params), deadline=deadline, **options)
+            if status != 200:
+                raise PlivoError('status %s fetching page at offset %s: %r'
+                                 % (status, offset, response))
+            objects = response.get('objects') or []
+            for obj in objects:
+                yield obj
+            if not objects or not (response.get('meta') or {}).get('next'):
+                return
+            offset += len(objects)
+
+    @staticmethod
+    def get_param(params, key):
+        try:
+            return params[key]
+        except KeyError:
+            raise PlivoError("missing mandatory parameter %s" % key)
+
+    # The single dispatch point for every method generated from ENDPOINTS.
+    # The caller's params are never modified; they are passed through as-is
+    # unless IDs have to be taken out or fixed values added.
+    def _call(self, endpoint, params, options):
+        if endpoint.deprecated:
+            raise PendingDeprecationWarning("This API is deprecated. Consider "
+                                            "using %s" % endpoint.deprecated)
+        if not params:
+            params = {}
+        path = endpoint.path
+        if endpoint.ids:
+            path %= tuple(self.get_param(params, key) for key in endpoint.ids)
+            params = dict((k, v) for k, v in params.items() if k not in endpoint.ids)
+        if not endpoint.forward:
+            params = dict(endpoint.fixed)
+        elif endpoint.fixed:
+            params = dict(params, **endpoint.fixed)
+        return self._request(endpoint.method, path, data=params, endpoint=endpoint, **options)
+
+
+# One row per API method. path is a %s format string filled from the params
+# named in ids, and template the same path with {} placeholders, which keys
+# the circuit breaker. idempotent GETs may be hedged and coalesced, bulk ones
+# (list endpoints and recording fetches by default) use the bulk lane,
+# paginated adds an iter_ method, fixed holds values always sent (replacing
+# the caller's other params unless forward is set) and deprecated names the
+# method to use instead.
+ApiEndpoint = namedtuple('ApiEndpoint', 'name method path ids template idempotent '
+                                        'bulk paginated fixed forward deprecated')
+
+
+def _endpoint(name, method, path, idempotent=None, bulk=None, paginated=False, fixed=None,
+              forward=True, deprecated=None):
+    segments = path.split('/')
+    ids = tuple(segment[1:-1] for segment in segments if segment.startswith('{'))
+    template = '/'.join('{}' if segment.startswith('{') else segment
+                        for segment in segments)
+    if idempotent is None:
+        idempotent = method != 'POST'
+    if bulk is None:
+        bulk = method == 'GET' and (template.startswith('/Recording/') or
+                                    template != '/' and '{}' not in template)
+    return ApiEndpoint(name, method, template.replace('{}', '%s'), ids, template,
+                       idempotent, bulk, paginated, fixed, forward, deprecated)
+
+
+ENDPOINTS = OrderedDict((endpoint.name, endpoint) for endpoint in (
+    ## Accounts ##
+    _endpoint('get_account', 'GET', '/'),
+    _endpoint('modify_account', 'POST', '/', idempotent=True),
+    _endpoint('get_subaccounts', 'GET', '/Subaccount/', paginated=True),
+    _endpoint('create_subaccount', 'POST', '/Subaccount/'),
+    _endpoint('get_subaccount', 'GET', '/Subaccount/{subauth_id}/'),
+    _endpoint('modify_subaccount', 'POST', '/Subaccount/{subauth_id}/', idempotent=True),
+    _endpoint('delete_subaccount', 'DELETE', '/Subaccount/{subauth_id}/'),
+    ## Applications ##
+    _endpoint('get_applications', 'GET', '/Application/', paginated=True),
+    _endpoint('create_application', 'POST', '/Application/'),
+    _endpoint('get_application', 'GET', '/Application/{app_id}/'),
+    _endpoint('modify_application', 'POST', '/Application/{app_id}/', idempotent=True),
+    _endpoint('delete_application', 'DELETE', '/Application/{app_id}/'),
+    ## Numbers ##
+    _endpoint('get_numbers', 'GET', '/Number/', paginated=True),
+    _endpoint('search_numbers', 'GET', '/AvailableNumber/',
+              deprecated='get_number_group_details'),
+    _endpoint('get_number', 'GET', '/Number/{number}/'),
+    _endpoint('rent_number', 'POST', '/AvailableNumber/{number}/',
+              deprecated='rent_from_number_group'),
+    _endpoint('unrent_number', 'DELETE', '/Number/{number}/'),
+    _endpoint('add_carrier_number', 'POST', '/Number/'),
+    _endpoint('modify_number', 'POST', '/Number/{number}/', idempotent=True),
+    _endpoint('link_application_number', 'POST', '/Number/{number}/', idempotent=True),
+    _endpoint('unlink_application_number', 'POST', '/Number/{number}/', idempotent=True,
+              fixed={'app_id': ''}, forward=False),
+    _endpoint('get_number_group', 'GET', '/AvailableNumberGroup/'),
+    _endpoint('get_number_group_details', 'GET', '/AvailableNumberGroup/{group_id}/'),
+    _endpoint('rent_from_number_group', 'POST', '/AvailableNumberGroup/{group_id}/'),
+    ## Calls ##
+    _endpoint('get_cdrs', 'GET', '/Call/', paginated=True),
+    _endpoint('get_cdr', 'GET', '/Call/{record_id}/'),
+    _endpoint('get_live_calls', 'GET', '/Call/', bulk=False, fixed={'status': 'live'}),
+    _endpoint('get_live_call', 'GET', '/Call/{call_uuid}/', fixed={'status': 'live'}),
+    _endpoint('get_call', 'GET', '/Call/{call_uuid}/'),
+    _endpoint('make_call', 'POST', '/Call/'),
+    _endpoint('hangup_all_calls', 'DELETE', '/Call/'),
+    _endpoint('transfer_call', 'POST', '/Call/{call_uuid}/'),
+    _endpoint('hangup_call', 'DELETE', '/Call/{call_uuid}/'),
+    _endpoint('record', 'POST', '/Call/{call_uuid}/Record/'),
+    _endpoint('stop_record', 'DELETE', '/Call/{call_uuid}/Record/'),
+    _endpoint('play', 'POST', '/Call/{call_uuid}/Play/'),
+    _endpoint('stop_play', 'DELETE', '/Call/{call_uuid}/Play/'),
+    _endpoint('speak', 'POST', '/Call/{call_uuid}/Speak/'),
+    _endpoint('stop_speak', 'DELETE', '/Call/{call_uuid}/Speak/'),
+    _endpoint('send_digits', 'POST', '/Call/{call_uuid}/DTMF/'),
+    ## Calls requests ##
+    _endpoint('hangup_request', 'DELETE', '/Request/{request_uuid}/'),
+    ## Conferences ##
+    _endpoint('get_live_conferences', 'GET', '/Conference/', bulk=False),
+    _endpoint('hangup_all_conferences', 'DELETE', '/Conference/'),
+    _endpoint('get_live_conference', 'GET', '/Conference/{conference_name}/'),
+    _endpoint('hangup_conference', 'DELETE', '/Conference/{conference_name}/'),
+    _endpoint('hangup_member', 'DELETE', '/Conference/{conference_name}/Member/{member_id}/'),
+    _endpoint('play_member', 'POST', '/Conference/{conference_name}/Member/{member_id}/Play/'),
+    _endpoint('stop_play_member', 'DELETE',
+              '/Conference/{conference_name}/Member/{member_id}/Play/'),
+    _endpoint('speak_member', 'POST', '/Conference/{conference_name}/Member/{member_id}/Speak/'),
+    _endpoint('deaf_member', 'POST',
+              '/Conference/{conference_name}/Member/{member_id}/Deaf/', idempotent=True),
+    _endpoint('undeaf_member', 'DELETE', '/Conference/{conference_name}/Member/{member_id}/Deaf/'),
+    _endpoint('mute_member', 'POST',
+              '/Conference/{conference_name}/Member/{member_id}/Mute/', idempotent=True),
+    _endpoint('unmute_member', 'DELETE', '/Conference/{conference_name}/Member/{member_id}/Mute/'),
+    _endpoint('kick_member', 'POST', '/Conference/{conference_name}/Member/{member_id}/Kick/'),
+    _endpoint('record_conference', 'POST', '/Conference/{conference_name}/Record/'),
+    _endpoint('stop_record_conference', 'DELETE', '/Conference/{conference_name}/Record/'),
+    ## Recordings ##
+    _endpoint('get_recordings', 'GET', '/Recording/', paginated=True),
+    _endpoint('get_recording', 'GET', '/Recording/{recording_id}/'),
     ## Endpoints ##
-    def get_endpoints(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Endpoint/', data=params)
+    _endpoint('get_endpoints', 'GET', '/Endpoint/', paginated=True),
+    _endpoint('create_endpoint', 'POST', '/Endpoint/'),
+    _endpoint('get_endpoint', 'GET', '/Endpoint/{endpoint_id}/'),
+    _endpoint('modify_endpoint', 'POST', '/Endpoint/{endpoint_id}/', idempotent=True),
+    _endpoint('delete_endpoint', 'DELETE', '/Endpoint/{endpoint_id}/'),
+    ## Carriers ##
+    _endpoint('get_incoming_carriers', 'GET', '/IncomingCarrier/', paginated=True),
+    _endpoint('create_incoming_carrier', 'POST', '/IncomingCarrier/'),
+    _endpoint('get_incoming_carrier', 'GET', '/IncomingCarrier/{carrier_id}/'),
+    _endpoint('modify_incoming_carrier', 'POST',
+              '/IncomingCarrier/{carrier_id}/', idempotent=True),
+    _endpoint('delete_incoming_carrier', 'DELETE', '/IncomingCarrier/{carrier_id}/'),
+    ## Carrier Routings ##
+    _endpoint('get_carrier_routings', 'GET', '/CarrierRouting/', paginated=True),
+    _endpoint('create_carrier_routing', 'POST', '/CarrierRouting/'),
+    _endpoint('get_carrier_routing', 'GET', '/CarrierRouting/{routing_id}/'),
+    _endpoint('modify_carrier_routing', 'POST', '/CarrierRouting/{routing_id}/', idempotent=True),
+    _endpoint('delete_carrier_routing', 'DELETE', '/CarrierRouting/{routing_id}/'),
+    ## Pricing ##
+    _endpoint('pricing', 'GET', '/Pricing/'),
+    ## Outgoing Carriers ##
+    ## To be added here ##
+    ## Message ##
+    _endpoint('send_message', 'POST', '/Message/'),
+    _endpoint('get_messages', 'GET', '/Message/', paginated=True),
+    _endpoint('get_message', 'GET', '/Message/{record_id}/'),
+))
+
+
+def _endpoint_method(endpoint):
+    def method(self, params=None, **options):
+        return self._call(endpoint, params, options)
+    method.__name__ = endpoint.name
+    return method
+
+
+def _iter_method(endpoint):
+    def method(self, params=None, **options):
+        return self._iterate(getattr(self, endpoint.name), params, **options)
+    method.__name__ = 'iter_' + endpoint.name[len('get_'):]
+    return method
+
+
+for _e in ENDPOINTS.values():
+    setattr(RestAPI, _e.name, _endpoint_method(_e))
+    if _e.paginated:
+        setattr(RestAPI, 'iter_' + _e.name[len('get_'):], _iter_method(_e))
+del _e
+
+
+class _Watch(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.snapshot = None
+        self.seq = None
+
+
+# Each watched call or conference is polled on its own interval, which halves
+# when a poll sees a change, grows by half when it doesn't and doubles when
+# the poll fails. All polls share one budget of `budget` requests per second.
+# Failed polls and malformed responses are reported as 'error' events with
+# the watch key and the exception. An exception raised by a handler goes to
+# the 'handler_error' handlers as (event, exception); polling carries on.
+class StatePoller(object):
+    def __init__(self, client, budget=5, min_interval=0.5, max_interval=30.0):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._budget = _TokenBucket(budget)
+        self._watches = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+
+    def on(self, event, handler):
+        self._handlers.setdefault(event, []).append(handler)
+
+    def watch_live_calls(self):
+        self._watch(('calls', None))
+
+    def watch_call(self, call_uuid):
+        self._watch(('call', call_uuid))
+
+    def watch_conference(self, conference_name):
+        self._watch(('conference', conference_name))
+
+    def unwatch_live_calls(self):
+        self._unwatch(('calls', None))
+
+    def unwatch_call(self, call_uuid):
+        self._unwatch(('call', call_uuid))
+
+    def unwatch_conference(self, conference_name):
+        self._unwatch(('conference', conference_name))
+
+    def _watch(self, key):
+        with self._lock:
+            if key not in self._watches:
+                self._watches[key] = _Watch(self.min_interval)
+                self._schedule(key, time.time())
+        self._wakeup.set()
+
+    def _unwatch(self, key):
+        with self._lock:
+            self._watches.pop(key, None)
+
+    def _schedule(self, key, due):
+        watch = self._watches[key]
+        watch.seq = next(self._seq)
+        heapq.heappush(self._heap, (due, watch.seq, key))
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            try:
+                delay = self.poll_once()
+            except Exception as e:
+                self._emit('error', None, e)
+                delay = self.min_interval
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def poll_once(self):
+        # Polls everything that is due and returns the number of seconds
+        # until the next poll is due.
+        while True:
+            with self._lock:
+                if not self._heap:
+                    return self.max_interval
+                due, seq, key = self._heap[0]
+                watch = self._watches.get(key)
+                if watch is None or watch.seq != seq:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = due - time.time()
+                if delay > 0:
+                    return delay
+                if not self._budget.try_acquire():
+                    return self._budget.wait_time()
+                heapq.heappop(self._heap)
+            events = self._poll(key, watch)
+            with self._lock:
+                if any(event[0] == 'error' for event in events):
+                    watch.interval = min(self.max_interval, watch.interval * 2.0)
+                elif events:
+                    watch.interval = max(self.min_interval, watch.interval / 2.0)
+                else:
+                    watch.interval = min(self.max_interval, watch.interval * 1.5)
+                if self._watches.get(key) is watch:
+                    self._schedule(key, time.time() + watch.interval)
+            for event in events:
+                self._emit(*event)
+
+    def _emit(self, event, *args):
+        for handler in self._handlers.get(event, ()):
+            try:
+                handler(*args)
+            except Exception as e:
+                if event != 'handler_error':
+                    self._emit('handler_error', event, e)
 
-    def create_endpoint(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Endpoint/', data=params)
+    def _poll(self, key, watch):
+        kind, name = key
+        try:
+            if kind == 'calls':
+                status, response = self.client.get_live_calls()
+            elif kind == 'call':
+                status, response = self.client.get_live_call({'call_uuid': name})
+            else:
+                status, response = self.client.get_live_conference(
+                    {'conference_name': name})
+        except Exception as e:
+            return [('error', key, e)]
+        if status == 404:
+            self._unwatch(key)
+            return [(kind + '_ended', name, watch.snapshot)]
+        if status != 200:
+            return [('error', key, PlivoError('status %s polling %s' % (status, key)))]
+        if isinstance(response, _LazyBody):
+            response = response.value
+        if not isinstance(response, dict):
+            return [('error', key, PlivoError('unexpected response polling %s: %r'
+                                              % (key, response)))]
+        previous = watch.snapshot
+        try:
+            if previous is None:
+                events = []
+            elif kind == 'calls':
+                events = self._diff_live_calls(previous, response)
+            elif kind == 'call':
+                events = self._diff_call(name, previous, response)
+            else:
+                events = self._diff_conference(name, previous, response)
+        except Exception as e:
+            return [('error', key, e)]
+        watch.snapshot = response
+        return events
 
-    def get_endpoint(self, params=None):
-        if not params: params = {}
-        endpoint_id = params.pop('endpoint_id')
-        return self._request('GET', '/Endpoint/%s/' % endpoint_id, data=params)
+    @staticmethod
+    def _diff_live_calls(previous, current):
+        before = set(previous.get('calls') or ())
+        after = set(current.get('calls') or ())
+        return ([('call_started', uuid) for uuid in after - before] +
+                [('call_ended', uuid, None) for uuid in before - after])
 
-    def modify_endpoint(self, params=None):
-        if not params: params = {}
-        endpoint_id = params.pop('endpoint_id')
-        return self._request('POST', '/Endpoint/%s/' % endpoint_id, data=params)
+    @staticmethod
+    def _diff_call(call_uuid, previous, current):
+        changes = {}
+        for k, v in current.items():
+            if k != 'api_id' and previous.get(k) != v:
+                changes[k] = (previous.get(k), v)
+        if changes:
+            return [('call_updated', call_uuid, changes)]
+        return []
 
-    def delete_endpoint(self, params=None):
-        if not params: params = {}
-        endpoint_id = params.pop('endpoint_id')
-        return self._request('DELETE', '/Endpoint/%s/' % endpoint_id, data=params)
+    @staticmethod
+    def _diff_conference(conference_name, previous, current):
+        before = dict((m['member_id'], m) for m in previous.get('members') or ())
+        after = dict((m['member_id'], m) for m in current.get('members') or ())
+        events = []
+        for member_id, member in after.items():
+            old = before.get(member_id)
+            if old is None:
+                events.append(('member_joined', conference_name, member))
+                continue
+            for field, on, off in (('muted', 'member_muted', 'member_unmuted'),
+                                   ('deaf', 'member_deafened', 'member_undeafened')):
+                if old.get(field) != member.get(field):
+                    events.append((on if member.get(field) else off,
+                                   conference_name, member))
+        for member_id, member in before.items():
+            if member_id not in after:
+                events.append(('member_left', conference_name, member))
+        return events
+
+
+# Collects member operations on the same conference, with the same action and
+# extra params, for up to `window` seconds and sends them as one request with
+# comma-separated member IDs. Each caller gets the status of its batch and
+# the response with the member_id list narrowed to its own member.
+class MemberBatcher(object):
+    def __init__(self, client, window=0.05, max_batch=50):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._cond = threading.Condition()
 
-    ## Carriers ##
-    def get_incoming_carriers(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/IncomingCarrier/', data=params)
+    def hangup_member(self, params=None):
+        return self._submit('hangup_member', params)
 
-    def create_incoming_carrier(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/IncomingCarrier/', data=params)
+    def kick_member(self, params=None):
+        return self._submit('kick_member', params)
 
-    def get_incoming_carrier(self, params=None):
-        if not params: params = {}
-        carrier_id = params.pop('carrier_id')
-        return self._request('GET', '/IncomingCarrier/%s/' % carrier_id, data=params)
+    def mute_member(self, params=None):
+        return self._submit('mute_member', params)
 
-    def modify_incoming_carrier(self, params=None):
-        if not params: params = {}
-        carrier_id = params.pop('carrier_id')
-        return self._request('POST', '/IncomingCarrier/%s/' % carrier_id, data=params)
+    def unmute_member(self, params=None):
+        return self._submit('unmute_member', params)
 
-    def delete_incoming_carrier(self, params=None):
-        if not params: params = {}
-        carrier_id = params.pop('carrier_id')
-        return self._request('DELETE', '/IncomingCarrier/%s/' % carrier_id, data=params)
+    def deaf_member(self, params=None):
+        return self._submit('deaf_member', params)
 
-    ## Carrier Routings ##
-    def get_carrier_routings(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/CarrierRouting/', data=params)
+    def undeaf_member(self, params=None):
+        return self._submit('undeaf_member', params)
 
-    def create_carrier_routing(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/CarrierRouting/', data=params)
+    def _submit(self, action, params):
+        params = dict(params or {})
+        conference_name = params.pop('conference_name')
+        member_id = str(params.pop('member_id'))
+        if member_id == 'all':
+            params.update(conference_name=conference_name, member_id=member_id)
+            return getattr(self.client, action)(params)
+        key = (action, conference_name, _freeze(params))
+        future = _Future()
+        with self._cond:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = []
+            batch.append((member_id, future))
+            if len(batch) >= self.max_batch:
+                self._cond.notify_all()
+        if leader:
+            self._flush(key, action, conference_name, params)
+        return future.result()
+
+    def _flush(self, key, action, conference_name, params):
+        deadline = time.time() + self.window
+        with self._cond:
+            while len(self._pending[key]) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending.pop(key)
+        for i in range(0, len(batch), self.max_batch):
+            chunk = batch[i:i + self.max_batch]
+            member_ids = []
+            for member_id, future in chunk:
+                if member_id not in member_ids:
+                    member_ids.append(member_id)
+            request = dict(params, conference_name=conference_name,
+                           member_id=','.join(member_ids))
+            try:
+                result = getattr(self.client, action)(request)
+            except Exception as e:
+                for member_id, future in chunk:
+                    future.set_exception(e)
+            else:
+                for member_id, future in chunk:
+                    future.set_result(self._member_result(result, member_id))
 
-    def get_carrier_routing(self, params=None):
-        if not params: params = {}
-        routing_id = params.pop('routing_id')
-        return self._request('GET', '/CarrierRouting/%s/' % routing_id, data=params)
+    @staticmethod
+    def _member_result(result, member_id):
+        status, response = result[0], result[1]
+        if isinstance(response, _LazyBody):
+            response = response.value
+        if isinstance(response, dict) and isinstance(response.get('member_id'), list):
+            response = dict(response, member_id=[m for m in response['member_id']
+                                                 if str(m) == member_id])
+        return (status, response)
+
+
+CallOutcome = namedtuple('CallOutcome', 'call_uuid action status response error')
+
+
+# Runs call control operations (hangup_call, transfer_call, speak, play, ...)
+# across a bounded pool of workers. Operations on the same call_uuid run in
+# the order they were submitted; different calls run in parallel.
+class CallFanout(object):
+    def __init__(self, client, workers=16, on_progress=None):
+        self.client = client
+        self.on_progress = on_progress
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._executor = _ShardedExecutor(workers)
+
+    def submit(self, action, params):
+        params = dict(params)
+        with self._lock:
+            self.submitted += 1
+        return self._executor.submit(params['call_uuid'], self._execute, action, params)
+
+    def _execute(self, action, params):
+        failed = True
+        try:
+            result = getattr(self.client, action)(params)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                self.completed += 1
+                if failed:
+                    self.failed += 1
+                progress = (self.completed, self.submitted)
+            if self.on_progress is not None:
+                self.on_progress(*progress)
+
+    def run(self, operations):
+        pending = []
+        for action, params in operations:
+            pending.append((params['call_uuid'], action, self.submit(action, params)))
+        outcomes = []
+        for call_uuid, action, future in pending:
+            try:
+                status, response = future.result()
+            except Exception as e:
+                outcomes.append(CallOutcome(call_uuid, action, None, None, e))
+            else:
+                outcomes.append(CallOutcome(call_uuid, action, status, response, None))
+        return outcomes
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+StepOutcome = namedtuple('StepOutcome', 'name action params status response error '
+                                        'started elapsed')
+
+
+# Stands for part of an earlier step's response, e.g. Ref('app', 'app_id')
+# or Ref('rent', 'numbers', 0, 'number'), and makes that step a dependency.
+class Ref(object):
+    def __init__(self, step, *path):
+        self.step = step
+        self.path = path
+
+    def resolve(self, responses):
+        value = responses[self.step]
+        for key in self.path:
+            value = value[key]
+        return value
+
+
+def _undo(action, id_param, key):
+    return lambda params, response: [(action, {id_param: response[key]})]
+
+
+# For each call that creates something, the calls that remove it again.
+_ROLLBACKS = {
+    'create_subaccount': _undo('delete_subaccount', 'subauth_id', 'auth_id'),
+    'create_application': _undo('delete_application', 'app_id', 'app_id'),
+    'create_endpoint': _undo('delete_endpoint', 'endpoint_id', 'endpoint_id'),
+    'create_incoming_carrier': _undo('delete_incoming_carrier', 'carrier_id', 'carrier_id'),
+    'create_carrier_routing': _undo('delete_carrier_routing', 'routing_id', 'routing_id'),
+    'rent_from_number_group': lambda params, response: [
+        ('unrent_number', {'number': number['number']})
+        for number in response.get('numbers') or []],
+    'link_application_number': lambda params, response: [
+        ('unlink_application_number', {'number': params['number']})],
+}
+
+
+# Runs a plan of API calls, each started as soon as the steps it depends on
+# (through Ref params or `after`) have succeeded, up to `workers` at a time.
+# Steps whose dependencies failed are skipped. Outcomes record when each step
+# started, relative to the start of run(), and how long it took. rollback()
+# undoes completed steps, newest first, with the matching delete_* calls.
+class Pipeline(object):
+    def __init__(self, client, workers=8):
+        self.client = client
+        self.workers = workers
+        self.outcomes = OrderedDict()
+        self.rollbacks = []
+        self._steps = OrderedDict()
+        self._completed = []
+
+    def add(self, name, action, params=None, after=()):
+        if name in self._steps:
+            raise ValueError('duplicate step %r' % name)
+        params = dict(params or {})
+        depends = set(after)
+        depends.update(value.step for value in params.values() if isinstance(value, Ref))
+        for step in depends:
+            if step not in self._steps:
+                raise ValueError('step %r depends on unknown step %r' % (name, step))
+        self._steps[name] = (action, params, depends)
+        return name
+
+    def _invoke(self, action, params):
+        try:
+            status, response = getattr(self.client, action)(params)
+        except Exception as e:
+            return None, None, e
+        if not 200 <= status < 300:
+            return status, response, PlivoError('status %s from %s: %r'
+                                                % (status, action, response))
+        return status, response, None
+
+    def _execute(self, name, action, params, responses, origin, done):
+        started = time.time()
+        try:
+            params = dict((key, value.resolve(responses) if isinstance(value, Ref) else value)
+                          for key, value in params.items())
+        except Exception as e:
+            status, response, error = None, None, e
+        else:
+            status, response, error = self._invoke(action, params)
+        done.put(StepOutcome(name, action, params, status, response, error,
+                             started - origin, time.time() - started))
+
+    def run(self, rollback=False):
+        # Returns the outcome of every step, in the order they were added.
+        # With rollback=True a failed plan is rolled back before returning.
+        origin = time.time()
+        done = queue.Queue()
+        responses = dict((name, outcome.response) for name, outcome in self.outcomes.items()
+                         if outcome.error is None)
+        waiting = OrderedDict((name, step) for name, step in self._steps.items()
+                              if name not in self.outcomes)
+        running = 0
+        executor = _Executor(self.workers)
+        try:
+            while waiting or running:
+                for name, (action, params, depends) in list(waiting.items()):
+                    failed = [step for step in depends
+                              if step in self.outcomes and self.outcomes[step].error]
+                    if failed:
+                        del waiting[name]
+                        self.outcomes[name] = StepOutcome(
+                            name, action, params, None, None,
+                            PlivoError('skipped, %s failed' % failed[0]), None, 0.0)
+                    elif all(step in responses for step in depends):
+                        del waiting[name]
+                        executor.submit(self._execute, name, action, params,
+                                        responses, origin, done)
+                        running += 1
+                if not running:
+                    continue
+                outcome = done.get()
+                running -= 1
+                self.outcomes[outcome.name] = outcome
+                if outcome.error is None:
+                    responses[outcome.name] = outcome.response
+                    self._completed.append(outcome.name)
+        finally:
+            executor.shutdown()
+        result = OrderedDict((name, self.outcomes[name]) for name in self._steps)
+        if rollback and any(outcome.error for outcome in result.values()):
+            self.rollback()
+        return result
+
+    def rollback(self, steps=None):
+        # Undoes the given completed steps, or all of them, and returns the
+        # outcomes of the undo calls. Steps with nothing to undo are ignored.
+        outcomes = []
+        for name in reversed(list(self._completed)):
+            if steps is not None and name not in steps:
+                continue
+            outcome = self.outcomes[name]
+            undo = _ROLLBACKS.get(outcome.action)
+            self._completed.remove(name)
+            if undo is None:
+                continue
+            for action, params in undo(outcome.params, outcome.response):
+                started = time.time()
+                status, response, error = self._invoke(action, params)
+                outcomes.append(StepOutcome(name, action, params, status, response, error,
+                                            None, time.time() - started))
+        self.rollbacks.extend(outcomes)
+        return outcomes
+
+
+# Hands out one RestAPI per (auth_id, auth_token), all sharing a single
+# transport and its connection pool. Clients idle for longer than
+# idle_timeout, or beyond the max_clients most recently used, are dropped.
+class ClientPool(object):
+    def __init__(self, max_clients=100, idle_timeout=300, transport=None,
+                 **client_options):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.client_options = client_options
+        if transport is None:
+            transport = RequestsTransport(pool_maxsize=50)
+        self.transport = transport
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, auth_id, auth_token):
+        key = (auth_id, auth_token)
+        now = time.time()
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is None:
+                client = RestAPI(auth_id, auth_token, transport=self.transport,
+                                 **self.client_options)
+            else:
+                client = entry[0]
+            self._clients[key] = (client, now)
+            self._evict(now)
+        return client
+
+    def _evict(self, now):
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)[1][0].close()
+        for key, (client, last_used) in list(self._clients.items()):
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._clients[key]
+            client.close()
+
+    def clear(self):
+        with self._lock:
+            for client, last_used in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+# A local copy of the account's numbers, indexed by number, prefix, app_id
+# and region. refresh() walks get_numbers a page at a time from where the
+# previous call stopped; numbers not seen during a complete pass are dropped.
+# modify_number, link/unlink_application_number and unrent_number calls made
+# through the same client are applied as soon as they succeed.
+class NumberInventory(object):
+    def __init__(self, client, page_size=100):
+        self.client = client
+        self.page_size = page_size
+        self._numbers = {}
+        self._sorted = []
+        self._by_app = {}
+        self._by_region = {}
+        self._offset = 0
+        self._seen = set()
+        self._lock = threading.RLock()
+        client.subscribe(self._observe)
+
+    def close(self):
+        self.client.unsubscribe(self._observe)
+
+    def refresh(self, max_pages=None, **options):
+        # Returns True once a full pass over the account's numbers is done.
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            status, response = self.client.get_numbers(
+                {'limit': self.page_size, 'offset': self._offset}, **options)
+            if status != 200:
+                raise PlivoError('status %s fetching numbers: %r' % (status, response))
+            pages += 1
+            objects = response.get('objects') or []
+            with self._lock:
+                for obj in objects:
+                    self._seen.add(obj['number'])
+                    self._store(dict(obj))
+                self._offset += len(objects)
+                if objects and (response.get('meta') or {}).get('next'):
+                    continue
+                for number in list(self._numbers):
+                    if number not in self._seen:
+                        self._remove(number)
+                self._offset = 0
+                self._seen = set()
+            return True
+        return False
 
-    def modify_carrier_routing(self, params=None):
-        if not params: params = {}
-        routing_id = params.pop('routing_id')
-        return self._request('POST', '/CarrierRouting/%s/' % routing_id, data=params)
+    @staticmethod
+    def _app_id(record):
+        application = record.get('application')
+        if not application:
+            return None
+        return application.rstrip('/').split('/')[-1]
+
+    def _store(self, record):
+        number = record['number']
+        if number in self._numbers:
+            self._unindex(self._numbers[number])
+        else:
+            bisect.insort(self._sorted, number)
+        record['app_id'] = self._app_id(record)
+        self._numbers[number] = record
+        if record['app_id']:
+            self._by_app.setdefault(record['app_id'], set()).add(number)
+        if record.get('region'):
+            self._by_region.setdefault(record['region'], set()).add(number)
+
+    def _unindex(self, record):
+        for index, key in ((self._by_app, record.get('app_id')),
+                           (self._by_region, record.get('region'))):
+            numbers = index.get(key)
+            if numbers is not None:
+                numbers.discard(record['number'])
+                if not numbers:
+                    del index[key]
+
+    def _remove(self, number):
+        record = self._numbers.pop(number, None)
+        if record is not None:
+            self._unindex(record)
+            del self._sorted[bisect.bisect_left(self._sorted, number)]
+
+    def _observe(self, method, path, data, status, response):
+        parts = path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'Number' or not 200 <= status < 300:
+            return
+        number = parts[1].lstrip('+')
+        with self._lock:
+            if method == 'DELETE':
+                self._remove(number)
+            elif method == 'POST' and number in self._numbers:
+                record = dict(self._numbers[number])
+                record.update(data)
+                if 'app_id' in data:
+                    record['application'] = data['app_id'] and (
+                        '/%s/Account/%s/Application/%s/' % (
+                            self.client.version, self.client.auth_id, data['app_id']))
+                self._store(record)
+
+    def get(self, number):
+        return self._numbers.get(number.lstrip('+'))
+
+    def by_app(self, app_id):
+        with self._lock:
+            return [self._numbers[n] for n in sorted(self._by_app.get(app_id, ()))]
+
+    def by_region(self, region):
+        with self._lock:
+            return [self._numbers[n] for n in sorted(self._by_region.get(region, ()))]
+
+    def with_prefix(self, prefix):
+        prefix = prefix.lstrip('+')
+        with self._lock:
+            i = bisect.bisect_left(self._sorted, prefix)
+            matches = []
+            while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+                matches.append(self._numbers[self._sorted[i]])
+                i += 1
+            return matches
+
+    def __contains__(self, number):
+        return number.lstrip('+') in self._numbers
+
+    def __len__(self):
+        return len(self._numbers)
+
+
+def _digits(number):
+    return ''.join(c for c in str(number) if c.isdigit())
+
+
+def _longest_prefix(table, lengths, number):
+    for length in lengths:
+        rate = table.get(number[:length])
+        if rate is not None:
+            return rate
+    return None
+
+
+# Per-destination rates from the pricing API for a fixed set of countries,
+# kept as prefix maps and optionally saved to `path`. Lookups match the
+# longest known prefix of each number. Loaded tables older than max_age
+# seconds are re-downloaded on the next lookup when auto_refresh is set;
+# otherwise call refresh() yourself.
+class RateTable(object):
+    def __init__(self, client, countries, path=None, max_age=86400,
+                 auto_refresh=True):
+        self.client = client
+        self.countries = list(countries)
+        self.path = path
+        self.max_age = max_age
+        self.auto_refresh = auto_refresh
+        self.updated_at = None
+        self._voice = {}
+        self._message = {}
+        self._country_codes = {}
+        self._voice_lengths = []
+        self._message_lengths = []
+        self._lock = threading.Lock()
+
+    def refresh(self, **options):
+        voice, message, country_codes = {}, {}, {}
+        for country_iso in self.countries:
+            status, response = self.client.pricing({'country_iso': country_iso}, **options)
+            if status != 200:
+                raise PlivoError('status %s fetching pricing for %s: %r'
+                                 % (status, country_iso, response))
+            country_code = str(response['country_code'])
+            country_codes[country_code] = response.get('country_iso', country_iso)
+            outbound = (response.get('voice') or {}).get('outbound') or {}
+            for entry in outbound.get('rates') or ():
+                for prefix in entry.get('prefix') or ():
+                    voice[_digits(prefix)] = float(entry['rate'])
+            rate = ((response.get('message') or {}).get('outbound') or {}).get('rate')
+            if rate is not None:
+                message[country_code] = float(rate)
+        self._install(time.time(), voice, message, country_codes)
+        if self.path is not None:
+            self.save()
+
+    def _install(self, updated_at, voice, message, country_codes):
+        with self._lock:
+            self.updated_at = updated_at
+            self._voice = voice
+            self._message = message
+            self._country_codes = country_codes
+            self._voice_lengths = sorted(set(map(len, voice)), reverse=True)
+            self._message_lengths = sorted(set(map(len, message)), reverse=True)
+
+    def save(self):
+        import json
+        import os
+        data = {'updated_at': self.updated_at, 'countries': self.countries,
+                'voice': self._voice, 'message': self._message,
+                'country_codes': self._country_codes}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp, self.path)
+
+    def load(self):
+        # Returns False when there is no saved table for these countries.
+        import json
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if sorted(data['countries']) != sorted(self.countries):
+            return False
+        self._install(data['updated_at'], data['voice'], data['message'],
+                      data['country_codes'])
+        return True
+
+    def stale(self):
+        return self.updated_at is None or time.time() - self.updated_at > self.max_age
+
+    def _ensure_fresh(self):
+        if self.updated_at is None and self.path is not None:
+            self.load()
+        if self.stale():
+            if self.updated_at is None or self.auto_refresh:
+                self.refresh()
+
+    def voice_rate(self, number):
+        return self.voice_rates([number])[0]
+
+    def message_rate(self, number):
+        return self.message_rates([number])[0]
+
+    def voice_rates(self, numbers):
+        self._ensure_fresh()
+        return self._lookup(self._voice, self._voice_lengths, numbers)
+
+    def message_rates(self, numbers):
+        self._ensure_fresh()
+        return self._lookup(self._message, self._message_lengths, numbers)
+
+    def countries_of(self, numbers):
+        self._ensure_fresh()
+        codes = self._country_codes
+        return self._lookup(codes, sorted(set(map(len, codes)), reverse=True), numbers)
+
+    def country_codes(self):
+        self._ensure_fresh()
+        return dict(self._country_codes)
+
+    def estimate_calls(self, numbers, minutes=1):
+        # Total per-minute cost for calling every number for `minutes`;
+        # numbers without a rate are skipped.
+        return sum(rate * minutes for rate in self.voice_rates(numbers)
+                   if rate is not None)
 
-    def delete_carrier_routing(self, params=None):
-        if not params: params = {}
-        routing_id = params.pop('routing_id')
-        return self._request('DELETE', '/CarrierRouting/%s/' % routing_id, data=params)
+    @staticmethod
+    def _lookup(table, lengths, numbers):
+        # Numbers in a batch share prefixes, so resolve each distinct
+        # leading run of digits once.
+        longest = lengths[0] if lengths else 0
+        resolved = {}
+        rates = []
+        for number in numbers:
+            head = _digits(number)[:longest]
+            if head not in resolved:
+                resolved[head] = _longest_prefix(table, lengths, head)
+            rates.append(resolved[head])
+        return rates
+
+
+# Runs get_number_group queries (dicts of country_iso, number_type, prefix,
+# region, ...) concurrently over a bounded pool, caching each query's groups
+# for `ttl` seconds, and merges the results ranked by price or stock.
+class NumberGroupSearch(object):
+    def __init__(self, client, workers=4, ttl=60):
+        self.client = client
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._executor = _Executor(workers)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def search(self, queries, rank='price', details=False, **options):
+        futures = [self._executor.submit(self._search_one, dict(query),
+                                         details, options)
+                   for query in queries]
+        groups = {}
+        for future in futures:
+            for group in future.result():
+                groups.setdefault(group['group_id'], group)
+        return sorted(groups.values(), key=self._rank_key(rank))
 
-    ## Pricing ##
-    def pricing(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Pricing/', data=params)
+    @staticmethod
+    def _rank_key(rank):
+        def price(group):
+            return float(group.get('monthly_rental_rate') or 0)
+
+        def stock(group):
+            return int(group.get('stock') or 0)
+
+        if rank == 'price':
+            return lambda group: (price(group), -stock(group))
+        elif rank == 'stock':
+            return lambda group: (-stock(group), price(group))
+        raise PlivoError('unknown rank %s' % rank)
+
+    def _search_one(self, query, details, options):
+        key = (_freeze(query), details)
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        status, response = self.client.get_number_group(dict(query), **options)
+        if status != 200:
+            raise PlivoError('status %s searching number groups %r: %r'
+                             % (status, query, response))
+        groups = response.get('objects') or []
+        if details:
+            detailed = []
+            for group in groups:
+                status, response = self.client.get_number_group_details(
+                    {'group_id': group['group_id']}, **options)
+                detailed.append(response if status == 200 else group)
+            groups = detailed
+        with self._lock:
+            for k, (expires, value) in list(self._cache.items()):
+                if expires <= now:
+                    del self._cache[k]
+            self._cache[key] = (now + self.ttl, groups)
+        return groups
+
+    def rent_best(self, queries, quantity=1, rank='price', **options):
+        for group in self.search(queries, rank, **options):
+            if int(group.get('stock') or 0) >= quantity:
+                return self.client.rent_from_number_group(
+                    {'group_id': group['group_id'], 'quantity': quantity}, **options)
+        raise PlivoError('no number group with %s numbers in stock' % quantity)
+
+
+DownloadOutcome = namedtuple('DownloadOutcome', 'recording_id path status error')
+
+
+# Downloads recording audio found through iter_recordings into `directory`,
+# `workers` files at a time. Each file is streamed to a .part file in chunks
+# and renamed when complete; an interrupted .part file is resumed with a
+# Range request. Files already on disk are skipped when their size matches
+# the server's Content-Length and, if the ETag is an MD5, their checksum.
+class RecordingDownloader(object):
+    def __init__(self, client, directory, workers=4, transport=None, timeout=None):
+        self.client = client
+        self.directory = directory
+        self.workers = workers
+        self.transport = transport or client.transport or RequestsTransport()
+        self.timeout = _timeout_pair(timeout)
+        self.headers = {'User-Agent': client.headers.get('User-Agent', 'PythonPlivo'),
+                        'Accept-Encoding': 'identity'}
+
+    def download(self, params=None, **options):
+        executor = _Executor(self.workers)
+        try:
+            pending = [(recording['recording_id'],
+                        executor.submit(self.download_one, recording))
+                       for recording in self.client.iter_recordings(params, **options)]
+            outcomes = []
+            for recording_id, future in pending:
+                try:
+                    path, status = future.result()
+                except Exception as e:
+                    outcomes.append(DownloadOutcome(recording_id, None, 'failed', e))
+                else:
+                    outcomes.append(DownloadOutcome(recording_id, path, status, None))
+            return outcomes
+        finally:
+            executor.shutdown(wait=False)
+
+    def _path(self, recording):
+        import os
+        try:
+            from urlparse import urlparse
+        except ImportError:
+            from urllib.parse import urlparse
+        extension = os.path.splitext(urlparse(recording['recording_url']).path)[1]
+        return os.path.join(self.directory, recording['recording_id'] + (extension or '.mp3'))
+
+    def download_one(self, recording):
+        # Returns (path, status) with status 'skipped', 'resumed' or
+        # 'downloaded'. Runs in the client's bulk lane when it has lanes.
+        lanes = self.client.lanes
+        if lanes is None:
+            return self._download(recording)
+        lanes.acquire(bulk=True)
+        try:
+            return self._download(recording)
+        finally:
+            lanes.release(bulk=True)
+
+    def _download(self, recording):
+        import os
+        url = recording['recording_url']
+        path = self._path(recording)
+        partial = path + '.part'
+        status, headers, body = self.transport.send('HEAD', url, dict(self.headers),
+                                                    None, self.timeout)
+        size = _get_header(headers, 'content-length') if status == 200 else None
+        size = int(size) if size is not None else None
+        if os.path.exists(path) and (size is None or os.path.getsize(path) == size) \
+                and self._checksum_matches(path, _get_header(headers, 'etag')):
+            return (path, 'skipped')
+
+        etag = _get_header(headers, 'etag')
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if size is not None and offset > size:
+            offset = 0
+        status = self._fetch(url, partial, offset)
+        resumed = offset > 0 and (status == 206 or status == 416 and offset == size)
+        refused = status == 416 and not resumed
+        if refused or resumed and not self._complete(partial, size, etag):
+            # The .part is stale: the server refused the range or the file
+            # has changed since. Start over.
+            os.remove(partial)
+            self._fetch(url, partial, 0)
+            resumed = False
+        if not self._complete(partial, size, etag):
+            raise PlivoError('incomplete or corrupt download of %s' % url)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(partial, path)
+        return (path, 'resumed' if resumed else 'downloaded')
+
+    def _fetch(self, url, partial, offset):
+        # Streams url into partial from offset and returns the status, which
+        # is 200, 206 or, for a range past the end, 416.
+        headers = dict(self.headers)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        status, response_headers, chunks = self.transport.stream('GET', url, headers,
+                                                                 None, self.timeout)
+        if status in (200, 206):
+            with open(partial, 'ab' if status == 206 and offset else 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            return status
+        for chunk in chunks:
+            pass
+        if status == 416 and offset:
+            return status
+        raise PlivoError('status %s downloading %s' % (status, url))
+
+    def _complete(self, partial, size, etag):
+        import os
+        return (size is None or os.path.getsize(partial) == size) \
+            and self._checksum_matches(partial, etag)
 
-    ## Outgoing Carriers ##
+    @staticmethod
+    def _checksum_matches(path, etag):
+        import hashlib
+        import re
+        etag = (etag or '').strip('"')
+        if not re.match('^[0-9a-f]{32}$', etag):
+            return True
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                md5.update(chunk)
+        return md5.hexdigest() == etag
+
+
+CDRTotals = namedtuple('CDRTotals', 'calls duration billed_duration amount')
+
+
+class _CDRWorker(object):
+    def __init__(self, params, country_codes, client_options):
+        self.params = params
+        self.country_codes = country_codes or {}
+        self.lengths = sorted(set(map(len, self.country_codes)), reverse=True)
+        self.clients = ClientPool(**client_options)
+
+    def __call__(self, subaccounts):
+        # Returns (totals, errors). A subaccount that fails is left out of the
+        # totals entirely and its error recorded by auth_id as a string, so
+        # the rest of the task still counts.
+        totals = {}
+        errors = {}
+        for auth_id, auth_token in subaccounts:
+            try:
+                CDRAggregator._merge(totals, self._totals(auth_id, auth_token))
+            except Exception as e:
+                errors[auth_id] = '%s: %s' % (type(e).__name__, e)
+        return totals, errors
+
+    def _totals(self, auth_id, auth_token):
+        totals = {}
+        client = self.clients.get(auth_id, auth_token)
+        for cdr in client.iter_cdrs(self.params):
+            direction = cdr.get('call_direction')
+            number = cdr.get('from_number' if direction == 'inbound' else 'to_number')
+            key = ((cdr.get('initiation_time') or cdr.get('end_time') or '')[:10],
+                   _longest_prefix(self.country_codes, self.lengths, _digits(number or '')),
+                   direction)
+            entry = totals.get(key)
+            if entry is None:
+                entry = totals[key] = [0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += int(cdr.get('call_duration') or 0)
+            entry[2] += int(cdr.get('bill_duration') or 0)
+            entry[3] += float(cdr.get('total_amount') or 0)
+        return totals
+
+
+_cdr_worker = None
+
+
+def _init_cdr_worker(*args):
+    global _cdr_worker
+    _cdr_worker = _CDRWorker(*args)
+
+
+def _run_cdr_worker(subaccounts):
+    return _cdr_worker(subaccounts)
+
+
+# Totals the CDRs of many subaccounts per (day, country, direction) across a
+# pool of `processes` worker processes, or in this process when processes is
+# 0. Each task walks get_cdrs for `per_task` subaccounts with clients from
+# the worker's own ClientPool, built from client_options, and returns partial
+# totals that are merged here. Countries are the ISO codes from
+# country_codes, a calling code to country map such as
+# RateTable.country_codes() returns, matched against the remote party's
+# number; None when unknown. Subaccounts whose CDRs could not be read are
+# left out of the totals and listed in `errors`, auth_id to error message,
+# after run().
+class CDRAggregator(object):
+    def __init__(self, client, processes=None, per_task=4, country_codes=None,
+                 **client_options):
+        self.client = client
+        self.processes = processes
+        self.per_task = per_task
+        self.country_codes = country_codes
+        self.client_options = client_options
+        self.errors = {}
+
+    def run(self, params=None, subaccounts=None):
+        # params filter every subaccount's CDRs, e.g. by end_time. Without
+        # subaccounts, given as (auth_id, auth_token) pairs, all of the
+        # account's subaccounts are included.
+        if subaccounts is None:
+            subaccounts = [(subaccount['auth_id'], subaccount['auth_token'])
+                           for subaccount in self.client.iter_subaccounts()]
+        subaccounts = list(subaccounts)
+        tasks = [subaccounts[i:i + self.per_task]
+                 for i in range(0, len(subaccounts), self.per_task)]
+        args = (dict(params or {}), self.country_codes, self.client_options)
+        totals = {}
+        self.errors = {}
+        if self.processes == 0:
+            worker = _CDRWorker(*args)
+            for task in tasks:
+                partial, errors = worker(task)
+                self._merge(totals, partial)
+                self.errors.update(errors)
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.processes, _init_cdr_worker, args)
+            try:
+                for partial, errors in pool.imap_unordered(_run_cdr_worker, tasks):
+                    self._merge(totals, partial)
+                    self.errors.update(errors)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        return dict((key, CDRTotals(*entry)) for key, entry in totals.items())
 
-    ## To be added here ##
+    @staticmethod
+    def _merge(totals, partial):
+        for key, entry in partial.items():
+            total = totals.get(key)
+            if total is None:
+                totals[key] = entry
+            else:
+                for i, value in enumerate(entry):
+                    total[i] += value
+
+
+CallEvent = namedtuple('CallEvent', 'call_uuid event call_status from_number to_number '
+                                    'direction duration bill_duration hangup_cause params')
+MessageEvent = namedtuple('MessageEvent', 'message_uuid status from_number to_number '
+                                          'units params')
+
+
+# Validates and decodes batches of raw callbacks, given as (uri, body,
+# signature) with the urlencoded POST body, into CallEvent and MessageEvent
+# records. Retries of a callback already seen (same CallUUID and Event or
+# CallStatus, or same MessageUUID and Status) are dropped, and accepted
+# events are passed to sink(events) in arrival order, batch_size at a time.
+class CallbackIngester(object):
+    def __init__(self, auth_token, sink, batch_size=500, dedupe_size=100000):
+        import hmac
+        from hashlib import sha1
+        self.sink = sink
+        self.batch_size = batch_size
+        self.dedupe_size = dedupe_size
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self._mac = hmac.new(_to_bytes(auth_token), digestmod=sha1)
+        self._seen = OrderedDict()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._sink_lock = threading.Lock()
 
-    ## Message ##
-    def send_message(self, params=None):
-        if not params: params = {}
-        return self._request('POST', '/Message/', data=params)
+    @staticmethod
+    def _params(body):
+        try:
+            from urlparse import parse_qsl
+        except ImportError:
+            from urllib.parse import parse_qsl
+        if isinstance(body, bytes) and not isinstance(body, str):
+            body = body.decode('utf-8')
+        return dict(parse_qsl(body, keep_blank_values=True))
+
+    @staticmethod
+    def decode(params):
+        if 'MessageUUID' in params:
+            return MessageEvent(params['MessageUUID'], params.get('Status'),
+                                params.get('From'), params.get('To'),
+                                params.get('Units'), params)
+        if 'CallUUID' in params:
+            return CallEvent(params['CallUUID'], params.get('Event'),
+                             params.get('CallStatus'), params.get('From'),
+                             params.get('To'), params.get('Direction'),
+                             params.get('Duration'), params.get('BillDuration'),
+                             params.get('HangupCause'), params)
+        return None
 
-    def get_messages(self, params=None):
-        if not params: params = {}
-        return self._request('GET', '/Message/', data=params)
+    @staticmethod
+    def _dedupe_key(event):
+        if isinstance(event, MessageEvent):
+            return ('message', event.message_uuid, event.status)
+        return ('call', event.call_uuid, event.event or event.call_status)
+
+    def ingest(self, callbacks):
+        # Returns the number of callbacks from this batch that were accepted.
+        events = []
+        rejected = 0
+        for uri, body, signature in callbacks:
+            params = self._params(body)
+            event = self.decode(params)
+            if event is None or _signature(self._mac, uri, params) != signature:
+                rejected += 1
+                continue
+            events.append(event)
+        accepted = []
+        with self._lock:
+            self.rejected += rejected
+            for event in events:
+                key = self._dedupe_key(event)
+                if key in self._seen:
+                    self.duplicates += 1
+                    continue
+                self._seen[key] = True
+                if len(self._seen) > self.dedupe_size:
+                    self._seen.popitem(last=False)
+                accepted.append(event)
+            self.accepted += len(accepted)
+            self._buffer.extend(accepted)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush(partial=False)
+        return len(accepted)
+
+    def flush(self, partial=True):
+        # A batch leaves the buffer only once sink() has returned, so a failing
+        # sink raises with its batch still queued for the next flush.
+        with self._sink_lock:
+            while True:
+                with self._lock:
+                    batch = self._buffer[:self.batch_size]
+                if not batch or not partial and len(batch) < self.batch_size:
+                    return
+                self.sink(batch)
+                with self._lock:
+                    del self._buffer[:len(batch)]
 
-    def get_message(self, params=None):
-        if not params: params = {}
-        record_id = params.pop('record_id')
-        return self._request('GET', '/Message/%s/' % record_id, data=params)
 
 class Element(object):
     nestables = ()
     valid_attributes = ()
 
     def __init__(self, body='', **attributes):
+        import xml.etree.ElementTree as etree
         self.attributes = {}
         self.name = self.__class__.__name__
         self.body = unicode(body).encode('ascii', 'xmlcharrefreplace')
@@ -501,6 +2947,7 @@ class Element(object):
         raise PlivoError('%s not nestable in %s' % (element.name, self.name))
 
     def to_xml(self):
+        import xml.etree.ElementTree as etree
         return etree.tostring(self.node, encoding="utf-8")
 
     def __str__(self):
@@ -2,10 +2,19 @@ import unittest
 import os
 import random
 import string
+import subprocess
+import sys
+import threading
 import time
 
 import plivo
 
+# With PLIVO_CASSETTE set, tests replay the exchanges stored in that file
+# instead of calling the API; adding PLIVO_RECORD=1 records them instead.
+CASSETTE = os.getenv("PLIVO_CASSETTE")
+RECORD = os.getenv("PLIVO_RECORD")
+REPLAY = CASSETTE and not RECORD
+
 try:
     from auth_secrets import AUTH_ID, AUTH_TOKEN
     from auth_secrets import DEFAULT_FROM_NUMBER, DEFAULT_TO_NUMBER, DEFAULT_TO_NUMBER2
@@ -14,6 +23,11 @@ except ImportError:
     DEFAULT_FROM_NUMBER = os.getenv("DEFAULT_FROM_NUMBER")
     DEFAULT_TO_NUMBER = os.getenv("DEFAULT_TO_NUMBER")
     DEFAULT_TO_NUMBER2 = os.getenv("DEFAULT_TO_NUMBER2")
+    if REPLAY:
+        AUTH_ID, AUTH_TOKEN = AUTH_ID or "MAXXXX", AUTH_TOKEN or "token"
+        DEFAULT_FROM_NUMBER = DEFAULT_FROM_NUMBER or "14155550100"
+        DEFAULT_TO_NUMBER = DEFAULT_TO_NUMBER or "14155550101"
+        DEFAULT_TO_NUMBER2 = DEFAULT_TO_NUMBER2 or "14155550102"
     if not (AUTH_ID and AUTH_TOKEN and
             DEFAULT_FROM_NUMBER and DEFAULT_TO_NUMBER):
         raise Exception("Create a auth_secrets.py file or set AUTH_ID "
@@ -22,6 +36,7 @@ except ImportError:
 
 
 client = None
+transport = None
 random_letter = lambda: random.choice(string.ascii_letters)
 random_string = lambda len: ''.join(random_letter() for i in range(len))
 
@@ -29,6 +44,9 @@ random_string = lambda len: ''.join(random_letter() for i in range(len))
 class PlivoTest(unittest.TestCase):
     "Adds a plivo client in setup"
     def setUp(self):
+        if CASSETTE:
+            # Random test data must repeat for requests to match the cassette.
+            random.seed(self.id())
         self.client = get_client(AUTH_ID, AUTH_TOKEN)
         self.some_timezones = ['Pacific/Apia', 'Pacific/Midway']
 
@@ -787,10 +805,1107 @@ class TestMessage(PlivoTest):
         self.check_status_and_keys(202, valid_keys, response)
         message_uuid = response[1]["message_uuid"][0]
         self.client.get_message({"record_id": message_uuid})
-        
-        
+
+
+class TestCoalescing(unittest.TestCase):
+    def upstream_requests(self, coalesce):
+        client = plivo.RestAPI('MAXXXX', 'token', coalesce=coalesce,
+                               transport=plivo.MemoryTransport(None))
+        sent = []
+
+        def send(method, path, data, timeout, deadline, endpoint, lazy=False):
+            sent.append(path)
+            time.sleep(0.2)
+            return (200, {'auth_id': 'MAXXXX'})
+        client._send = send
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.get_account()))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([(200, {'auth_id': 'MAXXXX'})] * 5, results)
+        self.assertEqual({}, client._inflight)
+        return len(sent)
+
+    def test_concurrent_gets_share_response(self):
+        self.assertEqual(1, self.upstream_requests(coalesce=True))
+        self.assertEqual(5, self.upstream_requests(coalesce=False))
+
+
+class TestStatePoller(PlivoTest):
+    def setUp(self):
+        super(TestStatePoller, self).setUp()
+        self.call_params = {'from': DEFAULT_FROM_NUMBER,
+                            'to': DEFAULT_TO_NUMBER,
+                            'answer_url':
+                            'https://guarded-island.herokuapp.com/conference/',
+                            'time_limit': 80
+                            }
+
+    def test_conference_member_events(self):
+        self.client.hangup_conference({'conference_name': 'plivo'})
+        events = []
+        poller = plivo.StatePoller(self.client, min_interval=1)
+        poller.on('member_joined', lambda name, member: events.append(member))
+        self.client.make_call(self.call_params)
+        #wait some time
+        time.sleep(8)
+        poller.watch_conference('plivo')
+        poller.start()
+        self.call_params['to'] = DEFAULT_TO_NUMBER2
+        self.client.make_call(self.call_params)
+        time.sleep(8)
+        poller.stop()
+        self.assertEqual(1, len(events))
+        self.client.hangup_conference({'conference_name': 'plivo'})
+
+    def test_errors_back_off(self):
+        client = plivo.RestAPI('MAXXXX', 'token', transport=plivo.MemoryTransport(
+            lambda method, url, headers, body: (503, {}, b'{}')))
+        poller = plivo.StatePoller(client, budget=100, min_interval=0.5)
+        errors = []
+        poller.on('error', lambda key, error: errors.append(error))
+        poller.watch_call('abc')
+        intervals = []
+        for i in range(4):
+            poller._schedule(('call', 'abc'), 0)
+            poller.poll_once()
+            intervals.append(poller._watches[('call', 'abc')].interval)
+        self.assertEqual([1.0, 2.0, 4.0, 8.0], intervals)
+        self.assertEqual(4, len(errors))
+
+    def test_bad_responses_and_handlers_do_not_stop_polling(self):
+        bodies = [b'{"call_status": "ringing"}', b'<html>maintenance</html>',
+                  b'{"call_status": "in-progress"}', b'{"call_status": "completed"}']
+        client = plivo.RestAPI('MAXXXX', 'token', transport=plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, bodies.pop(0) if len(bodies) > 1
+                                                else bodies[0])))
+        poller = plivo.StatePoller(client, budget=1000, min_interval=0.01, max_interval=0.05)
+        errors, updates, handler_errors = [], [], []
+        poller.on('error', lambda key, error: errors.append(error))
+        poller.on('handler_error', lambda event, error: handler_errors.append(event))
+
+        def on_update(call_uuid, changes):
+            updates.append(changes['call_status'][1])
+            raise ValueError('handler bug')
+        poller.on('call_updated', on_update)
+        poller.watch_call('abc')
+        poller.start()
+        try:
+            deadline = time.time() + 5
+            while len(updates) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            poller.stop()
+        self.assertEqual(['in-progress', 'completed'], updates)
+        self.assertEqual(['call_updated', 'call_updated'], handler_errors)
+        self.assertEqual(1, len(errors))
+
+    def test_diff_conference(self):
+        previous = {'members': [{'member_id': '1', 'muted': False},
+                                {'member_id': '2', 'muted': False}]}
+        current = {'members': [{'member_id': '1', 'muted': True},
+                               {'member_id': '3', 'muted': False}]}
+        events = plivo.StatePoller._diff_conference('plivo', previous, current)
+        names = sorted((e[0], e[2]['member_id']) for e in events)
+        self.assertEqual([('member_joined', '3'), ('member_left', '2'),
+                          ('member_muted', '1')], names)
+
+
+class TestMemberBatcher(unittest.TestCase):
+    def test_concurrent_mutes_share_one_request(self):
+        requests = []
+
+        class Client(object):
+            def mute_member(self, params):
+                requests.append(params)
+                return (202, {'message': 'mute member(s) initiated',
+                              'member_id': params['member_id'].split(',')[1:]})
+
+        batcher = plivo.MemberBatcher(Client(), window=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(
+            batcher.mute_member({'conference_name': 'plivo', 'member_id': i})))
+            for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(requests))
+        self.assertEqual(10, len(requests[0]['member_id'].split(',')))
+        self.assertEqual([202] * 10, [r[0] for r in results])
+        first = requests[0]['member_id'].split(',')[0]
+        self.assertEqual(sorted([[]] + [[str(i)] for i in range(10) if str(i) != first]),
+                         sorted(r[1]['member_id'] for r in results))
+
+
+class TestCallFanout(unittest.TestCase):
+    def test_per_call_order_is_preserved(self):
+        seen = {}
+
+        class Client(object):
+            def speak(self, params):
+                time.sleep(random.random() / 100)
+                seen.setdefault(params['call_uuid'], []).append(params['text'])
+                return (202, {})
+
+        operations = [('speak', {'call_uuid': 'call%d' % c, 'text': str(i)})
+                      for i in range(5) for c in range(10)]
+        with plivo.CallFanout(Client(), workers=4) as fanout:
+            outcomes = fanout.run(operations)
+        self.assertEqual(50, len(outcomes))
+        self.assertEqual(50, fanout.completed)
+        for texts in seen.values():
+            self.assertEqual(['0', '1', '2', '3', '4'], texts)
+
+
+class TestClientPool(PlivoTest):
+    def test_clients_are_reused_and_share_transport(self):
+        pool = plivo.ClientPool(max_clients=2, transport=get_transport())
+        client = pool.get(AUTH_ID, AUTH_TOKEN)
+        self.assertTrue(client is pool.get(AUTH_ID, AUTH_TOKEN))
+        self.assertTrue(client.transport is pool.transport)
+        self.assertEqual(200, client.get_account()[0])
+
+    def test_least_recently_used_client_is_evicted(self):
+        pool = plivo.ClientPool(max_clients=2, transport=get_transport())
+        first = pool.get('first', 'token')
+        pool.get('second', 'token')
+        pool.get('third', 'token')
+        self.assertEqual(2, len(pool))
+        self.assertFalse(first is pool.get('first', 'token'))
+
+    def test_cookies_are_not_shared_between_accounts(self):
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        cookies = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cookies.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'lb=backend-%d; Path=/' % len(cookies))
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        pool = plivo.ClientPool(url='http://127.0.0.1:%d' % server.server_port)
+        for auth_id in ('MAFIRST', 'MASECOND', 'MAFIRST'):
+            self.assertEqual(200, pool.get(auth_id, 'token').get_account()[0])
+        self.assertEqual([None, None, None], cookies)
+
+
+class TestImportTime(unittest.TestCase):
+    IMPORT_TIME_BUDGET = 0.1
+    LAZY_MODULES = ('requests', 'json', 'hmac', 'base64', 'xml.etree.ElementTree')
+
+    def test_import_is_fast_and_lazy(self):
+        code = ("import sys, time; t = time.time(); import plivo; "
+                "sys.stdout.write('%%f ' %% (time.time() - t)); "
+                "sys.stdout.write(' '.join(m for m in %r if m in sys.modules))"
+                % (self.LAZY_MODULES,))
+        here = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+        output = output.decode('ascii').split()
+        self.assertTrue(float(output[0]) < self.IMPORT_TIME_BUDGET)
+        self.assertEqual([], output[1:])
+
+
+class TestTransport(PlivoTest):
+    @unittest.skipIf(CASSETTE, 'exercises a real transport')
+    def test_urllib3_transport(self):
+        client = plivo.RestAPI(AUTH_ID, AUTH_TOKEN,
+                               transport=plivo.Urllib3Transport())
+        response = client.get_account()
+        self.assertEqual(200, response[0])
+        self.assertEqual(AUTH_ID, response[1]['auth_id'])
+
+    def test_memory_transport(self):
+        transport = plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, b'{"api_id": "1"}'))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        self.assertEqual((200, {'api_id': '1'}),
+                         client.get_cdrs({'limit': 5}))
+        self.assertEqual((200, {'api_id': '1'}),
+                         client.make_call({'to': DEFAULT_TO_NUMBER}))
+        (method, url, headers, body), (method2, url2, headers2, body2) = \
+            transport.requests
+        self.assertEqual('https://api.plivo.com/v1/Account/MAXXXX/Call/?limit=5', url)
+        self.assertEqual(None, body)
+        self.assertEqual('application/json', headers2['content-type'])
+        self.assertTrue(headers2['Authorization'].startswith('Basic '))
+
+    @unittest.skipIf(CASSETTE, 'exercises a real transport')
+    def test_prewarm(self):
+        transport = plivo.Urllib3Transport(dns_ttl=60, tcp_keepalive=True)
+        client = plivo.RestAPI(AUTH_ID, AUTH_TOKEN, transport=transport)
+        self.assertEqual(2, client.prewarm(2))
+        self.assertEqual(0, client.prewarm(2))
+        self.assertEqual(200, client.get_account()[0])
+
+    def test_keepalive_rewarms(self):
+        warmed = []
+
+        class WarmTransport(plivo.MemoryTransport):
+            def prewarm(self, url, connections=1):
+                warmed.append((url, connections))
+                return connections
+
+        transport = WarmTransport(lambda method, url, headers, body: (200, {}, b'{}'))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport,
+                               prewarm=3, keepalive=0.05)
+        time.sleep(0.2)
+        client.close()
+        self.assertTrue(len(warmed) >= 2)
+        self.assertEqual(('https://api.plivo.com/v1', 3), warmed[0])
+        self.assertEqual(len(warmed) * 3, client.metrics.snapshot()['prewarmed_connections'])
+
+
+    def test_warming_and_requests_share_default_transport(self):
+        built = []
+
+        class SlowTransport(plivo.MemoryTransport):
+            def __init__(self, **options):
+                time.sleep(0.1)
+                plivo.MemoryTransport.__init__(
+                    self, lambda method, url, headers, body: (200, {}, b'{}'))
+                built.append(self)
+
+            def prewarm(self, url, connections=1):
+                return connections
+
+        original = plivo.RequestsTransport
+        plivo.RequestsTransport = SlowTransport
+        self.addCleanup(setattr, plivo, 'RequestsTransport', original)
+        client = plivo.RestAPI('MAXXXX', 'token', prewarm=2)
+        self.assertEqual(200, client.get_account()[0])
+        client.close()
+        self.assertEqual(1, len(built))
+
+    def test_pool_closes_dropped_clients(self):
+        pool = plivo.ClientPool(max_clients=1, transport=plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, b'{}')), keepalive=60)
+        first = pool.get('first', 'token')
+        second = pool.get('second', 'token')
+        self.assertTrue(first._closed.is_set())
+        pool.clear()
+        self.assertTrue(second._closed.is_set())
+        for client in (first, second):
+            client._warmer.join(1)
+            self.assertFalse(client._warmer.is_alive())
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_default_codec_round_trip(self):
+        codec = plivo.default_codec()
+        body = codec.dumps({'to': '1212', 'time_limit': 80})
+        self.assertTrue(isinstance(body, bytes))
+        self.assertEqual({'to': '1212', 'time_limit': 80}, codec.loads(body))
+
+    def test_client_codec(self):
+        class CountingCodec(plivo.JSONCodec):
+            calls = 0
+
+            def loads(self, data):
+                CountingCodec.calls += 1
+                return plivo.JSONCodec.loads(self, data)
+
+        transport = plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, body))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport,
+                               codec=CountingCodec())
+        self.assertEqual((200, {'text': 'hi'}), client.send_message({'text': 'hi'}))
+        self.assertEqual(1, CountingCodec.calls)
+
+
+class TestCompression(unittest.TestCase):
+    def test_gzip_response_and_request(self):
+        import zlib
+        payload = ('{"objects": [%s]}' % ', '.join(['{"number": "14155550100"}'] * 200)).encode('ascii')
+        received = []
+
+        def handler(method, url, headers, body):
+            if body:
+                received.append(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return (200, {'Content-Encoding': 'gzip'},
+                    compressor.compress(payload) + compressor.flush())
+
+        client = plivo.RestAPI('MAXXXX', 'token', compress_threshold=100,
+                               transport=plivo.MemoryTransport(handler))
+        status, response = client.get_numbers()
+        self.assertEqual(200, len(response['objects']))
+        client.send_message({'text': 'x' * 500})
+        self.assertEqual({'text': 'x' * 500}, plivo.default_codec().loads(received[0]))
+        metrics = client.metrics.snapshot()
+        self.assertTrue(metrics['response_compression_ratio'] > 1)
+        self.assertTrue(metrics['request_compression_ratio'] > 1)
+
+
+class TestDeadlines(unittest.TestCase):
+    def page_handler(self, method, url, headers, body):
+        time.sleep(0.05)
+        return (200, {}, b'{"meta": {"next": "more"}, "objects": [{}, {}]}')
+
+    def test_expired_deadline_fails_fast(self):
+        transport = plivo.MemoryTransport(self.page_handler)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        deadline = plivo.Deadline(0)
+        self.assertRaises(plivo.PlivoTimeout, client.make_call, {}, deadline=deadline)
+        self.assertEqual([], transport.requests)
+
+    def test_deadline_covers_pagination(self):
+        transport = plivo.MemoryTransport(self.page_handler)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        cdrs = []
+        started = time.time()
+        try:
+            for cdr in client.iter_cdrs({'limit': 2}, deadline=0.3):
+                cdrs.append(cdr)
+        except plivo.PlivoTimeout:
+            pass
+        self.assertTrue(time.time() - started < 0.4)
+        self.assertTrue(0 < len(cdrs) < 14)
+
+    def test_transport_gets_connect_and_read_timeouts(self):
+        timeouts = []
+
+        class Transport(plivo.Transport):
+            def send(self, method, url, headers, body, timeout=None):
+                timeouts.append(timeout)
+                return (204, {}, b'')
+
+        client = plivo.RestAPI('MAXXXX', 'token', transport=Transport(),
+                               timeout=(3, 10))
+        client.hangup_call({'call_uuid': 'abc'})
+        client.hangup_call({'call_uuid': 'abc'}, timeout=1)
+        self.assertEqual([(3, 10), (1, 1)], timeouts)
+
+
+class TestHedging(unittest.TestCase):
+    def test_failed_get_falls_back_to_hedge(self):
+        calls = []
+
+        def handler(method, url, headers, body):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                raise plivo.PlivoTimeout('read timed out')
+            return (200, {}, b'{"call_uuid": "abc"}')
+
+        hedging = plivo.Hedging(budget=1, min_samples=1)
+        self.addCleanup(hedging.close)
+        hedging.record(0.05)
+        client = plivo.RestAPI('MAXXXX', 'token', hedging=hedging,
+                               transport=plivo.MemoryTransport(handler))
+        response = client.get_call({'call_uuid': 'abc'})
+        self.assertEqual((200, {'call_uuid': 'abc'}), response)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, client.metrics.snapshot()['hedge_wins'])
+        self.assertEqual([0.05], list(hedging._latencies))
+
+    def test_slow_get_is_hedged(self):
+        calls = []
+
+        def handler(method, url, headers, body):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(1)
+            return (200, {}, b'{"call_uuid": "abc"}')
+
+        hedging = plivo.Hedging(budget=1, min_samples=1)
+        self.addCleanup(hedging.close)
+        hedging.record(0.05)
+        client = plivo.RestAPI('MAXXXX', 'token', hedging=hedging,
+                               transport=plivo.MemoryTransport(handler))
+        started = time.time()
+        response = client.get_call({'call_uuid': 'abc'})
+        self.assertTrue(time.time() - started < 0.3)
+        self.assertEqual((200, {'call_uuid': 'abc'}), response)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, client.metrics.snapshot()['hedge_wins'])
+        self.assertEqual([0.05], list(hedging._latencies))
+
+    def test_workers_are_reused(self):
+        threads = set()
+
+        def handler(method, url, headers, body):
+            threads.add(threading.current_thread())
+            return (200, {}, b'{}')
+
+        hedging = plivo.Hedging(min_samples=1)
+        self.addCleanup(hedging.close)
+        hedging.record(1)
+        client = plivo.RestAPI('MAXXXX', 'token', hedging=hedging,
+                               transport=plivo.MemoryTransport(handler))
+        for i in range(20):
+            self.assertEqual(200, client.get_call({'call_uuid': 'abc'})[0])
+        # A caller can be answered just before its worker is back in the pool.
+        self.assertTrue(len(threads) <= 2)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_writes_are_not_hedged(self):
+        calls = []
+
+        def handler(method, url, headers, body):
+            calls.append(url)
+            time.sleep(0.2)
+            return (204, {}, b'')
+
+        hedging = plivo.Hedging(budget=1, min_samples=1)
+        self.addCleanup(hedging.close)
+        hedging.record(0.01)
+        client = plivo.RestAPI('MAXXXX', 'token', hedging=hedging,
+                               transport=plivo.MemoryTransport(handler))
+        client.hangup_call({'call_uuid': 'abc'})
+        self.assertEqual(1, len(calls))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_breaker_opens_per_endpoint_and_recovers(self):
+        status = {'/Recording/': 503}
+
+        def handler(method, url, headers, body):
+            for prefix, code in status.items():
+                if prefix in url:
+                    return (code, {}, b'{}')
+            return (200, {}, b'{}')
+
+        breaker = plivo.CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+        client = plivo.RestAPI('MAXXXX', 'token', breaker=breaker,
+                               transport=plivo.MemoryTransport(handler))
+        for i in range(2):
+            self.assertEqual(503, client.get_recording({'recording_id': i})[0])
+        self.assertRaises(plivo.CircuitOpenError, client.get_recording,
+                          {'recording_id': 'abc'})
+        self.assertEqual(200, client.get_call({'call_uuid': 'abc'})[0])
+        metrics = client.metrics.snapshot()
+        self.assertEqual('open', metrics['circuit_breakers']['/Recording/{}/'])
+        self.assertEqual('closed', metrics['circuit_breakers']['/Call/{}/'])
+        self.assertEqual(1, metrics['circuit_open_rejections'])
+
+        time.sleep(0.15)
+        status['/Recording/'] = 200
+        self.assertEqual(200, client.get_recording({'recording_id': 'abc'})[0])
+        self.assertEqual('closed', breaker.states()['/Recording/{}/'])
+
+
+class TestCassette(unittest.TestCase):
+    def test_record_then_replay(self):
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        responses = iter([b'{"call_uuid": "1"}', b'{"call_uuid": "2"}'])
+        recorder = plivo.RecordingTransport(plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, next(responses))), path)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=recorder)
+        recorded = [client.get_call({'call_uuid': 'abc'}),
+                    client.get_call({'call_uuid': 'abc'})]
+
+        client = plivo.RestAPI('MAYYYY', 'other', transport=plivo.ReplayTransport(path))
+        replayed = [client.get_call({'call_uuid': 'abc'}),
+                    client.get_call({'call_uuid': 'abc'})]
+        self.assertEqual(recorded, replayed)
+        self.assertEqual((200, {'call_uuid': '2'}), replayed[1])
+        self.assertRaises(plivo.PlivoError, client.get_call, {'call_uuid': 'other'})
+        with open(path) as f:
+            self.assertFalse('token' in f.read())
+
+    def test_subaccount_tokens_are_masked(self):
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        body = plivo.default_codec().dumps(
+            {'objects': [{'auth_id': 'SA1', 'auth_token': 'subsecret'}]})
+        recorder = plivo.RecordingTransport(plivo.MemoryTransport(
+            lambda method, url, headers, body_: (200, {'Content-Encoding': 'gzip'},
+                                                 plivo._gzip(body))), path)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=recorder)
+        self.assertEqual('subsecret', client.get_subaccounts()[1]['objects'][0]['auth_token'])
+        with open(path) as f:
+            self.assertFalse('subsecret' in f.read())
+        replayed = plivo.RestAPI('MAXXXX', 'token', transport=plivo.ReplayTransport(path))
+        self.assertEqual('XXXX', replayed.get_subaccounts()[1]['objects'][0]['auth_token'])
+
+
+class TestNumberInventory(unittest.TestCase):
+    def setUp(self):
+        self.numbers = [{'number': '1415555%04d' % i, 'region': 'CA',
+                         'application': '/v1/Account/MAXXXX/Application/1/'}
+                        for i in range(5)]
+        self.numbers.append({'number': '12125550100', 'region': 'NY',
+                             'application': None})
+
+        def handler(method, url, headers, body):
+            if method == 'GET':
+                return (200, {}, plivo.default_codec().dumps(
+                    {'meta': {'next': None}, 'objects': self.numbers}))
+            return (202, {}, b'{}')
+
+        self.client = plivo.RestAPI('MAXXXX', 'token',
+                                    transport=plivo.MemoryTransport(handler))
+        self.inventory = plivo.NumberInventory(self.client)
+        self.assertTrue(self.inventory.refresh())
+
+    def test_indexes(self):
+        self.assertEqual(6, len(self.inventory))
+        self.assertEqual('NY', self.inventory.get('+12125550100')['region'])
+        self.assertEqual(5, len(self.inventory.by_app('1')))
+        self.assertEqual(1, len(self.inventory.by_region('NY')))
+        self.assertEqual(5, len(self.inventory.with_prefix('1415')))
+
+    def test_changes_through_client_are_applied(self):
+        self.client.link_application_number({'number': '12125550100', 'app_id': '2'})
+        self.assertEqual(['12125550100'],
+                         [n['number'] for n in self.inventory.by_app('2')])
+        self.client.unlink_application_number({'number': '14155550000'})
+        self.assertEqual(4, len(self.inventory.by_app('1')))
+        self.client.unrent_number({'number': '14155550001'})
+        self.assertFalse('14155550001' in self.inventory)
+        self.client.modify_number({'number': '+14155550002', 'alias': 'front desk'})
+        self.assertEqual('front desk', self.inventory.get('14155550002').get('alias'))
+        self.client.unrent_number({'number': '+14155550003'})
+        self.assertFalse('14155550003' in self.inventory)
+
+    def test_refresh_drops_released_numbers(self):
+        del self.numbers[0]
+        self.inventory.refresh()
+        self.assertEqual(5, len(self.inventory))
+        self.assertEqual(None, self.inventory.get('14155550000'))
+
+
+class TestRateTable(unittest.TestCase):
+    def test_longest_prefix_and_persistence(self):
+        import tempfile
+        pricing = {'country_code': 1, 'country_iso': 'US',
+                   'voice': {'outbound': {'rates': [
+                       {'prefix': ['1'], 'rate': '0.01'},
+                       {'prefix': ['1907', '1808'], 'rate': '0.05'}]}},
+                   'message': {'outbound': {'rate': '0.0035'}}}
+        transport = plivo.MemoryTransport(lambda method, url, headers, body:
+                                          (200, {}, plivo.default_codec().dumps(pricing)))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'rates.json')
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, path)
+
+        table = plivo.RateTable(client, ['US'], path=path)
+        self.assertEqual([0.01, 0.05, None],
+                         table.voice_rates(['+14155550100', '19075550100', '447700900000']))
+        self.assertEqual(0.0035, table.message_rate('14155550100'))
+        self.assertEqual(1, len(transport.requests))
+
+        table = plivo.RateTable(client, ['US'], path=path)
+        self.assertEqual(0.05, table.voice_rate('18085550100'))
+        self.assertEqual(1, len(transport.requests))
+
+
+class TestNumberGroupSearch(unittest.TestCase):
+    def test_search_ranks_caches_and_rents(self):
+        groups = {'US': [{'group_id': '1', 'monthly_rental_rate': '0.80', 'stock': 5},
+                         {'group_id': '2', 'monthly_rental_rate': '0.50', 'stock': 1}],
+                  'GB': [{'group_id': '3', 'monthly_rental_rate': '0.50', 'stock': 40}]}
+
+        def handler(method, url, headers, body):
+            if method == 'POST':
+                return (201, {}, b'{"numbers": [{"number": "14155550100"}]}')
+            country_iso = url.split('country_iso=')[1][:2]
+            return (200, {}, plivo.default_codec().dumps({'objects': groups[country_iso]}))
+
+        transport = plivo.MemoryTransport(handler)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        search = plivo.NumberGroupSearch(client, workers=2)
+        self.addCleanup(search.close)
+        queries = [{'country_iso': 'US', 'number_type': 'local'},
+                   {'country_iso': 'GB', 'number_type': 'local'}]
+        self.assertEqual(['3', '2', '1'], [g['group_id'] for g in search.search(queries)])
+        self.assertEqual(['3', '1', '2'],
+                         [g['group_id'] for g in search.search(queries, rank='stock')])
+        self.assertEqual(2, len(transport.requests))
+
+        self.assertEqual(201, search.rent_best(queries, quantity=2)[0])
+        method, url, headers, body = transport.requests[-1]
+        self.assertTrue(url.endswith('/AvailableNumberGroup/3/'))
+
+
+class TestRecordingDownloader(unittest.TestCase):
+    def test_download_resume_and_skip(self):
+        import hashlib
+        import shutil
+        import tempfile
+        audio = {'https://s3.amazonaws.com/recordings/%s.mp3' % i: os.urandom(50000 + i)
+                 for i in range(3)}
+        recordings = [{'recording_id': str(i),
+                       'recording_url': 'https://s3.amazonaws.com/recordings/%s.mp3' % i}
+                      for i in range(3)]
+        ranges = []
+
+        def handler(method, url, headers, body):
+            if '/Recording/' in url:
+                return (200, {}, plivo.default_codec().dumps(
+                    {'meta': {'next': None}, 'objects': recordings}))
+            data = audio[url]
+            info = {'Content-Length': str(len(data)),
+                    'ETag': '"%s"' % hashlib.md5(data).hexdigest()}
+            if method == 'HEAD':
+                return (200, info, b'')
+            if 'Range' in headers:
+                ranges.append(headers['Range'])
+                start = int(headers['Range'][6:-1])
+                if start >= len(data):
+                    return (416, {}, b'')
+                return (206, {}, data[start:])
+            return (200, info, data)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        client = plivo.RestAPI('MAXXXX', 'token',
+                               transport=plivo.MemoryTransport(handler))
+        with open(os.path.join(directory, '1.mp3.part'), 'wb') as f:
+            f.write(audio['https://s3.amazonaws.com/recordings/1.mp3'][:1000])
+        downloader = plivo.RecordingDownloader(client, directory, workers=2, timeout=30)
+        self.assertEqual((30, 30), downloader.timeout)
+        outcomes = downloader.download()
+        self.assertEqual(['downloaded', 'resumed', 'downloaded'],
+                         [o.status for o in outcomes])
+        self.assertEqual(['bytes=1000-'], ranges)
+        for outcome in outcomes:
+            with open(outcome.path, 'rb') as f:
+                self.assertEqual(audio['https://s3.amazonaws.com/recordings/%s.mp3'
+                                       % outcome.recording_id], f.read())
+        self.assertEqual(['skipped'] * 3, [o.status for o in downloader.download()])
+
+        # Stale .part files: changed since the first bytes were fetched, full
+        # length but wrong, and longer than the recording.
+        stale = [b'x' * 1000, b'x' * 50001, b'x' * 60000]
+        for i, data in enumerate(stale):
+            os.remove(os.path.join(directory, '%d.mp3' % i))
+            with open(os.path.join(directory, '%d.mp3.part' % i), 'wb') as f:
+                f.write(data)
+        del ranges[:]
+        outcomes = downloader.download()
+        self.assertEqual(['downloaded'] * 3, [o.status for o in outcomes])
+        self.assertEqual(['bytes=1000-', 'bytes=50001-'], sorted(ranges))
+        for outcome in outcomes:
+            with open(outcome.path, 'rb') as f:
+                self.assertEqual(audio['https://s3.amazonaws.com/recordings/%s.mp3'
+                                       % outcome.recording_id], f.read())
+            self.assertFalse(os.path.exists(outcome.path + '.part'))
+
+
+class TestCallbackIngester(unittest.TestCase):
+    def sign(self, uri, params):
+        import hmac
+        from hashlib import sha1
+        mac = hmac.new(b'token', digestmod=sha1)
+        return plivo._signature(mac, uri, params)
+
+    def test_validate_dedupe_and_order(self):
+        try:
+            from urllib import urlencode
+        except ImportError:
+            from urllib.parse import urlencode
+        uri = 'https://example.com/callback/'
+        hangup = {'CallUUID': 'c1', 'Event': 'Hangup', 'From': '1', 'To': '2'}
+        queued = {'MessageUUID': 'm1', 'Status': 'queued'}
+        delivered = {'MessageUUID': 'm1', 'Status': 'delivered'}
+        self.assertTrue(plivo.validate_signature(uri, hangup, self.sign(uri, hangup), 'token'))
+        batches = []
+        ingester = plivo.CallbackIngester('token', batches.append, batch_size=2)
+        callbacks = [(uri, urlencode(p), self.sign(uri, p))
+                     for p in (hangup, queued, hangup, delivered)]
+        callbacks.append((uri, urlencode(hangup), 'forged'))
+        self.assertEqual(ingester.ingest(callbacks), 3)
+        self.assertEqual(len(batches), 1)
+        ingester.flush()
+        events = [e for batch in batches for e in batch]
+        self.assertEqual([type(e) for e in events],
+                         [plivo.CallEvent, plivo.MessageEvent, plivo.MessageEvent])
+        self.assertEqual([events[1].status, events[2].status], ['queued', 'delivered'])
+        self.assertEqual((ingester.accepted, ingester.duplicates, ingester.rejected), (3, 1, 1))
+
+    def test_failed_sink_keeps_batch(self):
+        uri = 'https://example.com/callback/'
+        calls = []
+
+        def sink(events):
+            calls.append(list(events))
+            if len(calls) == 1:
+                raise IOError('sink unavailable')
+
+        ingester = plivo.CallbackIngester('token', sink, batch_size=2)
+        params = [{'CallUUID': 'c%d' % i, 'Event': 'Hangup'} for i in range(3)]
+        callbacks = [(uri, '&'.join('%s=%s' % kv for kv in sorted(p.items())),
+                      self.sign(uri, p)) for p in params]
+        self.assertRaises(IOError, ingester.ingest, callbacks)
+        ingester.flush()
+        self.assertEqual([[e.call_uuid for e in batch] for batch in calls],
+                         [['c0', 'c1'], ['c0', 'c1'], ['c2']])
+
+
+class TestPriorityLanes(unittest.TestCase):
+    def test_bulk_leaves_reserved_capacity(self):
+        gate = threading.Event()
+
+        def handler(method, url, headers, body):
+            if '/Call/' in url:
+                gate.wait(5)
+            return (200, {}, b'{"objects": []}')
+
+        lanes = plivo.PriorityLanes(concurrency=2, reserved=1)
+        client = plivo.RestAPI('MAXXXX', 'token', lanes=lanes,
+                               transport=plivo.MemoryTransport(handler))
+        export = threading.Thread(target=client.get_cdrs)
+        export.start()
+        try:
+            while lanes.stats()['bulk'] != 1:
+                time.sleep(0.01)
+            self.assertRaises(plivo.PlivoTimeout, client.get_cdrs, deadline=0.1)
+            self.assertEqual(client.get_account()[0], 200)
+            self.assertEqual(client.get_live_conferences()[0], 200)
+            self.assertRaises(plivo.PlivoTimeout, client.get_endpoints, deadline=0.1)
+            self.assertEqual(client.get_endpoints(priority='interactive')[0], 200)
+            self.assertRaises(ValueError, client.get_account, priority='urgent')
+        finally:
+            gate.set()
+            export.join()
+        self.assertEqual(lanes.stats(), {'interactive': 0, 'bulk': 0, 'waiting': 0})
+
+    def test_bulk_rate_is_capped(self):
+        lanes = plivo.PriorityLanes(concurrency=4, reserved=1, rate=100, reserved_rate=90)
+        started = time.time()
+        for _ in range(15):
+            lanes.acquire(bulk=True)
+            lanes.release(bulk=True)
+        self.assertTrue(time.time() - started >= 0.4)
+        started = time.time()
+        lanes.acquire()
+        lanes.release()
+        self.assertTrue(time.time() - started < 0.1)
+
+
+class TestEndpoints(unittest.TestCase):
+    def test_generated_methods(self):
+        transport = plivo.MemoryTransport(lambda method, url, headers, body: (200, {}, b'{}'))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        params = {'conference_name': 'room', 'member_id': '7', 'text': 'hi'}
+        self.assertEqual(client.speak_member(params)[0], 200)
+        self.assertEqual(params, {'conference_name': 'room', 'member_id': '7', 'text': 'hi'})
+        method, url, headers, body = transport.requests[-1][:4]
+        self.assertEqual((method, url), ('POST', client._api + '/Conference/room/Member/7/Speak/'))
+        self.assertEqual(plivo.default_codec().loads(body), {'text': 'hi'})
+        client.get_live_calls()
+        self.assertTrue(transport.requests[-1][1].endswith('/Call/?status=live'))
+        self.assertRaises(plivo.PlivoError, client.hangup_call, {})
+        self.assertRaises(PendingDeprecationWarning, client.search_numbers)
+        for endpoint in plivo.ENDPOINTS.values():
+            self.assertTrue(hasattr(client, endpoint.name))
+            if endpoint.paginated:
+                self.assertTrue(hasattr(client, 'iter_' + endpoint.name[4:]))
+        self.assertEqual(plivo.ENDPOINTS['hangup_member'].template,
+                         '/Conference/{}/Member/{}/')
+        client.unlink_application_number({'number': '1415', 'alias': 'x'})
+        self.assertEqual(plivo.default_codec().loads(transport.requests[-1][3]), {'app_id': ''})
+
+    def test_spec_drives_breaker_and_lanes(self):
+        gate = threading.Event()
+
+        def handler(method, url, headers, body):
+            if '/Call/' in url and 'status=live' not in url:
+                gate.wait(5)
+            return (500 if '/Number/' in url else 200, {}, b'{}')
+
+        breaker = plivo.CircuitBreaker(failure_threshold=1)
+        lanes = plivo.PriorityLanes(concurrency=2, reserved=1)
+        client = plivo.RestAPI('MAXXXX', 'token', breaker=breaker, lanes=lanes,
+                               transport=plivo.MemoryTransport(handler))
+        client.modify_number({'number': '14155550100', 'alias': 'x'})
+        self.assertEqual('open', breaker.states()['/Number/{}/'])
+        export = threading.Thread(target=client.get_cdrs)
+        export.start()
+        try:
+            while lanes.stats()['bulk'] != 1:
+                time.sleep(0.01)
+            self.assertEqual(200, client.get_live_calls(deadline=1)[0])
+        finally:
+            gate.set()
+            export.join()
+
+
+class TestPipeline(unittest.TestCase):
+    def test_free_worker_takes_next_step(self):
+        def handler(method, url, headers, body):
+            if method == 'POST':
+                time.sleep(0.5)
+            return (200, {}, b'{}')
+
+        client = plivo.RestAPI('MAXXXX', 'token', transport=plivo.MemoryTransport(handler))
+        pipeline = plivo.Pipeline(client, workers=2)
+        pipeline.add('slow', 'create_application', {'app_name': 'acme'})
+        pipeline.add('a', 'get_account')
+        pipeline.add('b', 'get_account')
+        outcomes = pipeline.run()
+        self.assertTrue(outcomes['b'].started < 0.25)
+
+    def test_dependencies_parallelism_and_rollback(self):
+        codec = plivo.default_codec()
+
+        def handler(method, url, headers, body):
+            path = url.split('/MAXXXX')[1].split('?')[0]
+            if method == 'POST' and path == '/Application/':
+                time.sleep(0.1)
+                return (201, {}, codec.dumps({'app_id': 'A1'}))
+            if method == 'POST' and path == '/AvailableNumberGroup/G1/':
+                time.sleep(0.1)
+                return (201, {}, codec.dumps({'numbers': [{'number': '100'}, {'number': '200'}]}))
+            if method == 'POST' and path == '/Endpoint/':
+                return (201, {}, codec.dumps({'endpoint_id': 'E-' + codec.loads(body)['app_id']}))
+            if method == 'POST' and path == '/Number/200/':
+                return (500, {}, b'{}')
+            return (202 if method == 'POST' else 204, {}, b'')
+
+        transport = plivo.MemoryTransport(handler)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        pipeline = plivo.Pipeline(client)
+        pipeline.add('app', 'create_application', {'app_name': 'acme'})
+        pipeline.add('rent', 'rent_from_number_group', {'group_id': 'G1', 'quantity': 2})
+        pipeline.add('endpoint', 'create_endpoint', {'app_id': plivo.Ref('app', 'app_id')})
+        for i in range(2):
+            pipeline.add('link%d' % i, 'link_application_number',
+                         {'number': plivo.Ref('rent', 'numbers', i, 'number'),
+                          'app_id': plivo.Ref('app', 'app_id')})
+        pipeline.add('notify', 'get_account', after=['link1'])
+        outcomes = pipeline.run(rollback=True)
+
+        self.assertEqual(list(outcomes), ['app', 'rent', 'endpoint', 'link0', 'link1', 'notify'])
+        self.assertTrue(abs(outcomes['app'].started - outcomes['rent'].started) < 0.05)
+        self.assertTrue(outcomes['app'].elapsed >= 0.1)
+        self.assertEqual(outcomes['endpoint'].response, {'endpoint_id': 'E-A1'})
+        self.assertEqual(outcomes['link1'].status, 500)
+        self.assertTrue(isinstance(outcomes['notify'].error, plivo.PlivoError))
+        self.assertEqual(outcomes['notify'].status, None)
+        undone = sorted((o.action, tuple(o.params.items())) for o in pipeline.rollbacks)
+        self.assertEqual(undone, [('delete_application', (('app_id', 'A1'),)),
+                                  ('delete_endpoint', (('endpoint_id', 'E-A1'),)),
+                                  ('unlink_application_number', (('number', '100'),)),
+                                  ('unrent_number', (('number', '100'),)),
+                                  ('unrent_number', (('number', '200'),))])
+        actions = [o.action for o in pipeline.rollbacks]
+        self.assertTrue(actions.index('unlink_application_number') < actions.index('unrent_number'))
+        self.assertTrue(actions.index('delete_endpoint') < actions.index('delete_application'))
+
+
+class TestLazyResponse(unittest.TestCase):
+    def test_decodes_on_access(self):
+        decoded = []
+        codec = plivo.JSONCodec()
+
+        class CountingCodec(object):
+            def dumps(self, obj):
+                return codec.dumps(obj)
+
+            def loads(self, data):
+                decoded.append(data)
+                return codec.loads(data)
+
+        transport = plivo.MemoryTransport(
+            lambda method, url, headers, body: (204, {}, b'{"message": "call hung up"}'))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport,
+                               codec=CountingCodec(), lazy=True)
+        status, response = client.hangup_call({'call_uuid': 'abc'})
+        self.assertEqual(status, 204)
+        self.assertEqual(decoded, [])
+        self.assertEqual(response['message'], 'call hung up')
+        self.assertEqual(response.get('api_id'), None)
+        self.assertEqual(len(decoded), 1)
+        result = client.hangup_call({'call_uuid': 'abc'})
+        self.assertTrue(isinstance(result, tuple))
+        self.assertEqual(result.status, 204)
+        self.assertEqual(result.content, b'{"message": "call hung up"}')
+        self.assertEqual(result, (204, {'message': 'call hung up'}))
+        self.assertEqual(len(decoded), 2)
+        status, response = client.hangup_call({'call_uuid': 'abc'}, lazy=False)
+        self.assertEqual(type(response), dict)
+
+    def test_truthiness_matches_decoded_body(self):
+        bodies = [b'{}', b'[]', b'', b'{"api_id": "1"}']
+        transport = plivo.MemoryTransport(
+            lambda method, url, headers, body: (200, {}, bodies.pop(0)))
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport, lazy=True)
+        self.assertEqual([False, False, False, True],
+                         [bool(client.get_account()[1]) for i in range(4)])
+
+
+class TestCDRAggregator(unittest.TestCase):
+    def test_partials_are_merged(self):
+        import multiprocessing
+        codec = plivo.default_codec()
+
+        def handler(method, url, headers, body):
+            if '/Subaccount/' in url:
+                objects = [{'auth_id': 'SA%d' % i, 'auth_token': 't'} for i in range(6)]
+            elif '/SA5/' in url:
+                return (500, {}, b'{}')
+            else:
+                objects = [{'call_direction': 'outbound', 'to_number': '14155550100',
+                            'initiation_time': '2026-09-30 23:59:00+00:00',
+                            'call_duration': 61, 'bill_duration': 120, 'total_amount': '0.01'},
+                           {'call_direction': 'inbound', 'from_number': '447700900000',
+                            'initiation_time': '2026-10-01 00:00:10+00:00',
+                            'call_duration': 5, 'bill_duration': 60, 'total_amount': '0.00'}]
+            return (200, {}, codec.dumps({'meta': {'next': None}, 'objects': objects}))
+
+        transport = plivo.MemoryTransport(handler)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport)
+        expected = {('2026-09-30', 'US', 'outbound'): (5, 305, 600),
+                    ('2026-10-01', 'GB', 'inbound'): (5, 25, 300)}
+        processes = [0]
+        if getattr(multiprocessing, 'get_start_method', lambda: 'fork')() == 'fork':
+            processes.append(2)
+        for n in processes:
+            aggregator = plivo.CDRAggregator(client, processes=n, per_task=2,
+                                             country_codes={'1': 'US', '44': 'GB'},
+                                             transport=transport)
+            totals = aggregator.run({'end_time__gte': '2026-09-01'})
+            self.assertEqual(dict((key, value[:3]) for key, value in totals.items()), expected)
+            self.assertAlmostEqual(totals[('2026-09-30', 'US', 'outbound')].amount, 0.05)
+            self.assertEqual(['SA5'], list(aggregator.errors))
+
+
+class TestSharedRateLimiter(unittest.TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_processes_share_one_budget(self):
+        if not hasattr(os, 'fork'):
+            self.skipTest('needs os.fork')
+        limiter = plivo.SharedRateLimiter(20, capacity=5, directory=self.directory)
+        started = time.time()
+        pids = []
+        for i in range(3):
+            pid = os.fork()
+            if pid == 0:
+                for _ in range(5):
+                    limiter.acquire('MAXXXX')
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertTrue(time.time() - started >= 0.45)
+        self.assertRaises(plivo.PlivoTimeout, limiter.acquire, 'MAXXXX',
+                          deadline=plivo.Deadline(0.01))
+
+    def test_429_backs_off_every_client(self):
+        responses = [(429, {'Retry-After': '0.3'}, b'{}'), (200, {}, b'{}')]
+        transport = plivo.MemoryTransport(lambda method, url, headers, body: responses.pop(0))
+        limiter = plivo.SharedRateLimiter(100, directory=self.directory)
+        client = plivo.RestAPI('MAXXXX', 'token', transport=transport, rate_limiter=limiter)
+        self.assertEqual(429, client.get_account()[0])
+        started = time.time()
+        self.assertEqual(200, client.get_account()[0])
+        self.assertTrue(time.time() - started >= 0.25)
+        self.assertEqual(1, client.metrics.snapshot()['rate_limit_waits'])
+
+    def test_buckets_are_closed(self):
+        if not hasattr(os, 'fork'):
+            self.skipTest('needs os.fork')
+        limiter = plivo.SharedRateLimiter(100, directory=self.directory)
+        limiter.acquire('MAXXXX')
+        fd, state, lock = limiter._buckets['MAXXXX']
+        pid = os.fork()
+        if pid == 0:
+            limiter.acquire('MAXXXX')
+            try:
+                state[:1]
+            except ValueError:
+                os._exit(0)
+            os._exit(1)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+        state[:1]
+        limiter.close()
+        self.assertEqual({}, limiter._buckets)
+        self.assertRaises(ValueError, lambda: state[:1])
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_threads_share_one_budget(self):
+        limiter = plivo.SharedRateLimiter(0.001, capacity=100, directory=self.directory)
+        state = limiter._state
+
+        class SlowState(object):
+            size = state.size
+            pack = state.pack
+
+            def unpack(self, data):
+                time.sleep(0.0001)
+                return state.unpack(data)
+
+        limiter._state = SlowState()
+        granted = []
+
+        def take():
+            for i in range(50):
+                try:
+                    limiter.acquire('MAXXXX', deadline=plivo.Deadline(1))
+                except plivo.PlivoTimeout:
+                    pass
+                else:
+                    granted.append(i)
+
+        threads = [threading.Thread(target=take) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(100, len(granted))
+
+    def test_default_directory_is_private(self):
+        import stat
+        import tempfile
+        self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+        tempfile.tempdir = self.directory
+        plivo.SharedRateLimiter(10).acquire('MAXXXX')
+        private = os.path.join(self.directory, 'plivo-ratelimit-%d' % os.getuid())
+        self.assertEqual(0o700, stat.S_IMODE(os.lstat(private).st_mode))
+        self.assertTrue(os.path.exists(os.path.join(private, 'plivo-ratelimit-MAXXXX')))
+        os.chmod(private, 0o777)
+        self.assertRaises(plivo.PlivoError, plivo.SharedRateLimiter(10).acquire, 'MAXXXX')
+        os.symlink(os.path.join(self.directory, 'elsewhere'),
+                   os.path.join(self.directory, 'plivo-ratelimit-SAXXXX'))
+        limiter = plivo.SharedRateLimiter(10, directory=self.directory)
+        self.assertRaises(OSError, limiter.acquire, 'SAXXXX')
+
+
+def get_transport():
+    global transport
+    if CASSETTE and transport is None:
+        if RECORD:
+            transport = plivo.RecordingTransport(plivo.RequestsTransport(), CASSETTE)
+        else:
+            transport = plivo.ReplayTransport(CASSETTE)
+    return transport
+
+
 def get_client(AUTH_ID, AUTH_TOKEN):
-    return plivo.RestAPI(AUTH_ID, AUTH_TOKEN)
+    return plivo.RestAPI(AUTH_ID, AUTH_TOKEN, transport=get_transport())
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file